@@ -1,39 +1,113 @@
 import pandas as pd
 import numpy as np
 import re
+from amp_tests.utils import BidBook, as_bid_book, grouped_rolling_mean
 
 
 
-def ref_level(bids:pd.DataFrame, min_bid=0, max_bid=800, days=90) -> pd.Series:
+def average_bid(bids:pd.DataFrame|BidBook, min_bid=0, max_bid=800) -> pd.Series:
+    """MW-weighted average price of the segments priced within (min_bid, max_bid) for each bid."""
     
-    price = bids.filter(regex='Segment [0-9]+ Price')
-    mw = bids.filter(regex='Segment [0-9]+ MW')
-    price = price.rename(columns={c: i for i, c in enumerate(price.columns)})
-    mw = mw.rename(columns={c: i for i, c in enumerate(mw.columns)})
+    book = as_bid_book(bids)
+    # considers only bids within bounds
+    mw = np.where((book.price > min_bid) & (book.price < max_bid), book.mw, 0)
     
-    for col in mw.columns: # considers only bids within bounds
-        mw[col] = mw[col].where(price[col] > min_bid, other=0)
-        mw[col] = mw[col].where(price[col] < max_bid, other=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_bid = np.nansum(book.price * mw, axis=1, dtype=float) / np.nansum(mw, axis=1, dtype=float)
+
+    return pd.Series(avg_bid, index=book.index)
+
+
+
+def ref_level(bids:pd.DataFrame|BidBook, min_bid=0, max_bid=800, days:int|list=90) -> pd.Series|pd.DataFrame:
+    """
+    Rolling average of the average bids of each asset over the last days * 24 bids, lagged by 24 hours.
+    With a list of days, returns a DataFrame with one column of reference levels per window.
+    """
+    
+    avg_bid = average_bid(bids, min_bid=min_bid, max_bid=max_bid)
+    windows = [d * 24 for d in np.atleast_1d(days)]
+    ref = grouped_rolling_mean(avg_bid, "Masked Asset ID", windows, lag=24, min_periods=1)
+    ref.columns = np.atleast_1d(days)
+
+    return ref if isinstance(days, (list, tuple, np.ndarray)) else ref[days].rename(None)
+
+
+
+def ref_level_state(bids:pd.DataFrame|BidBook, min_bid=0, max_bid=800, days=90) -> pd.Series:
+    """
+    Builds the state needed to extend ref_level with new hours: the last days * 24 + 24
+    average bids of each asset (rolling window plus the 24-hour lag). The window length is
+    stored in state.attrs and the state can be saved with save_ref_level_state.
+    """
+
+    avg_bid = average_bid(bids, min_bid=min_bid, max_bid=max_bid).rename("avg_bid")
+    state = avg_bid.groupby("Masked Asset ID").tail(days * 24 + 24)
+    state.attrs = {"days": days, "min_bid": min_bid, "max_bid": max_bid}
+
+    return state
+
+
+
+def append_ref_level(state:pd.Series, bids:pd.DataFrame|BidBook) -> tuple[pd.Series, pd.Series]:
+    """
+    Computes the reference levels of new bids from the state of the previous hours, with the
+    same semantics as ref_level on the full history (shift(24).rolling(days * 24, min_periods=1)
+    over the bids of each asset). The new bids must be later than the state of their asset.
+    Returns the reference levels of the new bids and the updated state.
+    """
+
+    days, min_bid, max_bid = state.attrs["days"], state.attrs["min_bid"], state.attrs["max_bid"]
+    avg_bid = average_bid(bids, min_bid=min_bid, max_bid=max_bid).rename("avg_bid")
+
+    last = state.index.to_frame(index=False).groupby("Masked Asset ID")["DateTime"].max()
+    new = avg_bid.index.to_frame(index=False)
+    if (new["DateTime"].to_numpy() <= new["Masked Asset ID"].map(last).to_numpy()).any():
+        raise ValueError("New bids must be later than the last hour of their asset in the state.")
+
+    history = pd.concat([state, avg_bid])
+    history.attrs = {}
+    ref = grouped_rolling_mean(history, "Masked Asset ID", [days * 24], lag=24, min_periods=1)[days * 24]
+    ref = ref.reindex(avg_bid.index).rename(None)
+
+    state = history.groupby("Masked Asset ID").tail(days * 24 + 24)
+    state.attrs = {"days": days, "min_bid": min_bid, "max_bid": max_bid}
+
+    return ref, state
+
+
+
+def save_ref_level_state(state:pd.Series, path) -> None:
+    """Saves the state of the reference levels (with its window and price bounds) to a .parquet file."""
+    
+    frame = state.to_frame()
+    frame.attrs = dict(state.attrs)
+    frame.to_parquet(path)
+
+
+
+def load_ref_level_state(path) -> pd.Series:
+    """Loads a state saved with save_ref_level_state."""
     
-    avg_bid = (price * mw).sum(axis=1) / mw.sum(axis=1)   
-    avg_group = avg_bid.groupby("Masked Asset ID", group_keys=False)
-    ref = lambda x, days: x.shift(24).rolling(days * 24, min_periods=1).mean()
-    ref_level = avg_group.apply(lambda x: ref(x, days))
+    state = pd.read_parquet(path)
+    attrs = state.attrs
+    state = state["avg_bid"]
+    state.attrs = attrs
 
-    return ref_level
+    return state
 
 
 
 def reference_levels(
-    bids:pd.DataFrame,
+    bids:pd.DataFrame|BidBook,
     hub_price:pd.Series,
     accepted_only:bool = False,
     fill_nans:bool = True,
     must_run:bool = False,
     lower_bound: float = -1000,
     upper_bound: float = 1000,
-    days: int = 90,
-) -> pd.DataFrame:
+    days: int|list = 90,
+) -> pd.Series|pd.DataFrame:
     """ "Computes offer-based reference levels for a series of bids indexed by
     DateTime, Masked Lead Participant ID and Masked Asset ID. First,
     computes daily average of bids then computes a rolling average of the last
@@ -48,57 +122,102 @@ def reference_levels(
         must_run (bool): If True, includes must run bids. Defaults to False.
         lower_bound (float): Lower bound for the bids. Bids <= are set to 0 MW. Defaults to -1000.
         upper_bound (float): Upper bound for the bids. Bids >= are set to 0 MW. Defaults to 1000.
-        days (int): Number of days to consider for the rolling average. Defaults to 90.
+        days (int|list): Number of days to consider for the rolling average, or a list of numbers of days
+            computed in one pass. Defaults to 90.
 
     Returns:
         ref_levels (pd.Series): Series with reference levels indexed by DateTime, Masked Lead Participant ID and Masked Asset ID.
+        With a list of days, pd.DataFrame with one column per number of days (rows where all are NaN are dropped).
         NOTE: Some assets might have incomplete ref_levels due to lack of accepted bids.
     """
 
-    copy_bids = bids.copy()
-    
-    if must_run: # if must run, keep both must run and economic units
-        copy_bids = copy_bids[copy_bids["Unit Status"] != "UNAVAILABLE"]
-    else: 
-        copy_bids = copy_bids[copy_bids["Unit Status"] == "ECONOMIC"]
-
+    book = as_bid_book(bids)
     
-    copy_bids, hub_price = copy_bids.align(hub_price, axis=0, join='inner')
-
-    revenue = pd.Series(0, index=copy_bids.index, dtype=float)
-    quantity = pd.Series(0, index=copy_bids.index, dtype=float)
-
-    for s in range(1, 11):
-        price_s = copy_bids[f"Segment {s} Price"]
-        quantity_s = copy_bids[f"Segment {s} MW"]
-
-        # if accepted only, the upper bound should be at least as tight as the upper bound, lower if hub price is lower
-        if accepted_only: 
-            upper_bound = hub_price.where(hub_price < upper_bound, other=upper_bound)
-        in_range = (price_s > lower_bound) & (price_s < upper_bound)
-        price_s = price_s.where(cond=in_range, other=0)
-        quantity_s = quantity_s.where(cond=in_range, other=0)
-        
-        revenue += price_s * quantity_s
-        quantity += quantity_s
-      
-    avg = revenue / quantity
-    group_avg = avg.groupby(["Masked Lead Participant ID", "Masked Asset ID"], group_keys=False)
-
-    # shift back by one day (24 hours) and compute rolling average
-    ref = group_avg.apply(lambda x: x.shift(24).rolling(days*24).mean())
+    # if must run, keep both must run and economic units, and only hours with a hub price
+    in_hub = book.hour_ix.hours.isin(hub_price.index)[book.hour_codes]
+    book = book.take(book.available(must_run) & in_hub)
+
+    # if accepted only, the upper bound should be at least as tight as the upper bound, lower if hub price is lower
+    if accepted_only: 
+        hub = hub_price.reindex(book.hour_ix.hours).to_numpy()[book.hour_codes]
+        upper_bound = np.where(hub < upper_bound, hub, upper_bound)[:, None]
+    in_range = (book.price > lower_bound) & (book.price < upper_bound)
+    price = np.where(in_range, book.price, 0)
+    quantity = np.where(in_range, book.mw, 0)
+
+    revenue = (price * quantity).sum(axis=1, dtype=float)
+    quantity = quantity.sum(axis=1, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg = pd.Series(revenue / quantity, index=book.index)
+    by = ["Masked Lead Participant ID", "Masked Asset ID"]
+
+    # shift back by one day (24 hours) and compute rolling averages
+    ref = grouped_rolling_mean(avg, by, [d * 24 for d in np.atleast_1d(days)], lag=24)
+    ref.columns = np.atleast_1d(days)
+    if not isinstance(days, (list, tuple, np.ndarray)):
+        ref = ref[days].rename("Reference Level")
 
     if fill_nans:
-        ref = ref.groupby(["Masked Lead Participant ID", "Masked Asset ID"]).ffill().bfill()
+        ref = ref.groupby(level=by).ffill().bfill()
     
     ref = ref.dropna(how="all")
-    ref.name = "Reference Level"
 
     return ref
     
 
 
 
+def mitigate_period(
+    bids: pd.DataFrame,
+    pst: pd.Series,
+    ref_levels: pd.Series,
+    rel_ref: int = 3,
+    abs_ref: int = 100,
+    default_ref: float = 0,
+    fill_by: str|list = ["DateTime", "Masked Asset ID"],
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Mitigates the bids of any number of hours in one pass. Missing reference levels are filled once
+    within fill_by groups (default: each asset in each hour, as when mitigating hour by hour), the
+    conduct thresholds are computed with np.minimum and the segment prices of pivotal suppliers above
+    threshold are replaced by the reference level with a single np.where over the segment matrix.
+    pst is indexed by DateTime and Masked Lead Participant ID (or by the full bid index).
+
+    Returns:
+        bids (pd.DataFrame): mitigated bids.
+        counts (pd.DataFrame): per DateTime, number of bids of pivotal suppliers ('pst') and of
+        mitigated bids for each segment price column.
+    """
+
+    ### fill missing ref levels so that no unit is removed
+    ref_levels = ref_levels.groupby(level=fill_by).ffill()
+    ref_levels = ref_levels.groupby(level=fill_by).bfill().fillna(default_ref)
+    ref = ref_levels.reindex(bids.index).to_numpy(dtype=float)
+
+    pst_key = bids.index.droplevel([n for n in bids.index.names if n not in pst.index.names])
+    pst_key = pst_key.reorder_levels(pst.index.names) if pst_key.nlevels > 1 else pst_key
+    pst = pst.reindex(pst_key, fill_value=False).to_numpy(dtype=bool)
+
+    threshold = np.minimum(ref + abs_ref, ref * rel_ref)
+    price_cols = [c for c in bids.columns if re.match("Segment [0-9]+ Price", c)]
+    price = bids[price_cols].to_numpy(dtype=float)
+
+    # check whether unit is PST (structure) and bid is above ref level (conduct)
+    cond = (price > threshold[:, None]) & pst[:, None]
+    price = np.where(cond, ref[:, None], price)
+
+    bids = bids.copy()
+    bids[price_cols] = price
+    bids = bids.dropna(how="all")
+
+    counts = pd.DataFrame(cond, columns=price_cols, index=pst_key.get_level_values("DateTime"))
+    counts.insert(0, "pst", pst)
+    counts = counts.groupby(level="DateTime").sum()
+
+    return bids, counts
+
+
+
 def mitigate_bids(
     bids: pd.DataFrame,
     pst: pd.Series,
@@ -110,24 +229,15 @@ def mitigate_bids(
 ) -> pd.DataFrame:
 
 
-    ### fill missing ref levels so that no unit is removed
-    ref_fill = lambda x: x.ffill().bfill().fillna(default_ref)
-    ref_levels = ref_levels.groupby('Masked Asset ID').transform(ref_fill)
-    df = bids.join(pst).join(ref_levels)
-    bids, pst, ref_levels = df.iloc[:, :-2], df.iloc[:, -2], df.iloc[:, -1]
-    threshold = ref_levels.map(lambda x: min(x + abs_ref, x * rel_ref))
+    ### fill missing ref levels by asset so that no unit is removed
+    bids, counts = mitigate_period(
+        bids, pst, ref_levels, rel_ref=rel_ref, abs_ref=abs_ref, 
+        default_ref=default_ref, fill_by="Masked Asset ID"
+    )
 
-    print("Structural test (# bids):", pst.sum()) if verbose else None
+    print("Structural test (# bids):", counts["pst"].sum()) if verbose else None
     
-    for col in bids.columns:
-        # check whether unit is PST (structure) and bid is above ref level (conduct)
-        if re.match("Segment [0-9]+ Price", col):
-            cond = (bids[col] > threshold) & pst
-            bids.loc[cond, col] = ref_levels[cond]
-
-        else:
-            continue
-        print(col, "mitigated bids:", cond.sum()) if verbose else None
+    for col in counts.columns[1:]:
+        print(col, "mitigated bids:", counts[col].sum()) if verbose else None
 
-    bids = bids.dropna(how="all")
     return bids
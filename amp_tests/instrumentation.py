@@ -0,0 +1,177 @@
+"""
+
+Stage-level instrumentation of the simulation and dataset runs. Each stage (load, RSI, reference levels,
+congestion test, mitigation, clearing, write, ...) records its wall time, CPU time and peak resident memory;
+skipped hours are counted by reason and one stage can be run under cProfile. Everything is reported as JSON
+at the end of the run instead of being printed hour by hour.
+
+Usage:
+    instr = Instrumentation(profile="clearing")
+    with instr.stage("clearing"):
+        ...
+    instr.skip("congested", n=12)
+    instr.save("report.json")
+
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import threading
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+
+def current_rss() -> int|None:
+    """Resident memory of the process in bytes (None where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return None
+
+
+def max_rss() -> int|None:
+    """Peak resident memory of the process since it started, in bytes (None where it is not available)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024 # bytes on macOS, kilobytes on Linux
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident memory every interval seconds in a background thread and keeps the maximum."""
+
+    def __init__(self, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss() or 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def stop(self) -> int:
+        """Stops sampling and returns the peak resident memory in bytes."""
+        self._done.set()
+        self.join()
+        return max(self.peak, current_rss() or 0)
+
+
+
+@dataclass
+class Instrumentation:
+    """
+    Collects the stage timings, counters and skip reasons of one run. Stages can be entered several times
+    (e.g. once per window or scenario): their times are summed and their peak memory is the maximum.
+    CPU time is the time of this process (worker processes are not included). Where /proc is not available,
+    the peak memory of a stage is the peak of the process up to the end of the stage.
+    """
+
+    profile: str = None  # name of the stage run under cProfile
+    profile_path: Path = None  # where its stats are dumped (default: <stage>.prof)
+    stages: dict = field(default_factory=dict)
+    skipped: dict = field(default_factory=dict)
+    counters: dict = field(default_factory=dict)
+    started: datetime = field(default_factory=datetime.now)
+    _clock: tuple = field(default_factory=lambda: (time.perf_counter(), time.process_time()), repr=False)
+    _profiler: cProfile.Profile = field(default=None, repr=False) # accumulates all the calls of the profiled stage
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measures the block as stage name."""
+
+        sampler = RssSampler() if current_rss() is not None else None
+        sampler.start() if sampler else None
+        if name == self.profile and self._profiler is None:
+            self._profiler = cProfile.Profile()
+        profiler = self._profiler if name == self.profile else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        profiler.enable() if profiler else None
+
+        try:
+            yield
+        finally:
+            profiler.disable() if profiler else None
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            peak = sampler.stop() if sampler else max_rss()
+
+            record = self.stages.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": None})
+            record["calls"] += 1
+            record["wall_s"] += wall
+            record["cpu_s"] += cpu
+            if peak is not None:
+                record["peak_rss_mb"] = max(record["peak_rss_mb"] or 0, peak / 2**20)
+
+    def skip(self, reason: str, n: int = 1) -> None:
+        """Counts n skipped items (e.g. hours) for reason."""
+        self.skipped[reason] = self.skipped.get(reason, 0) + int(n)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Adds n to the counter name (e.g. mitigated bids, rows written)."""
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def dump_profile(self, top: int = 20) -> dict:
+        """Saves the stats of the profiled stage (all its calls so far) to profile_path and returns its top
+        functions by cumulative time."""
+
+        path = Path(self.profile_path or f"{self.profile}.prof")
+        self._profiler.dump_stats(path)
+        stats = pstats.Stats(self._profiler).stats
+        rows = sorted(stats.items(), key=lambda kv: kv[1][3], reverse=True)[:top]
+        top = [
+            {"function": f"{file}:{line}({func})", "calls": nc, "tottime_s": tt, "cumtime_s": ct}
+            for (file, line, func), (_, nc, tt, ct, _) in rows
+        ]
+
+        return {"stage": self.profile, "path": str(path), "top": top}
+
+    def report(self) -> dict:
+        """Report of the run so far: totals, stages, skipped items by reason, counters and profile."""
+
+        wall, cpu = self._clock
+        report = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_s": time.perf_counter() - wall,
+            "cpu_s": time.process_time() - cpu,
+            "peak_rss_mb": max_rss() / 2**20 if max_rss() is not None else None,
+            "stages": self.stages,
+            "skipped": self.skipped,
+            "counters": self.counters,
+        }
+        if self._profiler is not None:
+            report["profile"] = self.dump_profile()
+
+        return report
+
+    def summary(self) -> str:
+        """One line per stage and the skip counts, to print at the end of a run."""
+
+        lines = [f"{'stage':<20} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'peak MB':>9}"]
+        for name, s in self.stages.items():
+            peak = f"{s['peak_rss_mb']:>9.0f}" if s["peak_rss_mb"] is not None else f"{'-':>9}"
+            lines.append(f"{name:<20} {s['calls']:>6} {s['wall_s']:>9.2f} {s['cpu_s']:>9.2f} {peak}")
+        lines += [f"skipped ({reason}): {n}" for reason, n in self.skipped.items()]
+
+        return "\n".join(lines)
+
+    def save(self, path: Path) -> Path:
+        """Writes the report as JSON to path."""
+        path = Path(path)
+        path.write_text(json.dumps(self.report(), indent=2))
+        return path
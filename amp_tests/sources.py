@@ -0,0 +1,104 @@
+import os
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from datetime import datetime as dt
+
+
+CACHE_ENV = "AMP_ARROW_CACHE" # directory of the Arrow cache, used when read_source gets no cache_dir
+
+
+def cache_path(path: Path, cache_dir: Path) -> Path:
+    """
+    Path of the uncompressed Arrow IPC copy of a source file. The name is keyed on the resolved source path
+    and on its modification time and size, so a modified source gets a new cache entry.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    path_key = hashlib.sha1(str(path).encode()).hexdigest()[:8]
+    version_key = hashlib.sha1(f"{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()[:8]
+    return Path(cache_dir) / f"{path.stem}-{path_key}-{version_key}.arrow"
+
+
+def cached_table(path: Path, cache_dir: Path) -> pa.Table:
+    """
+    Returns the table of a .parquet source, memory-mapped from its Arrow IPC copy in cache_dir. The copy is
+    written on the first read (and older copies of the same source are removed), later reads only map the
+    file, so parquet decompression and decoding are skipped. The mapped pages stay in the OS page cache between
+    runs, but converting the table to pandas (as read_source does) still makes a private copy in each process.
+    """
+    cached = cache_path(path, cache_dir)
+
+    if not cached.exists():
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        for stale in cached.parent.glob(f"{cached.stem.rsplit('-', 1)[0]}-*.arrow"):
+            if stale != cached: # another process may have written the current copy meanwhile
+                stale.unlink(missing_ok=True)
+
+        table = pq.read_table(path)
+        tmp = cached.with_suffix(f".{os.getpid()}.tmp") # written aside, then renamed: readers never see a partial file
+        with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp, cached)
+
+    # the returned buffers point into the mapping, which stays open as long as they are referenced
+    return pa.ipc.open_file(pa.memory_map(str(cached), "r")).read_all()
+
+
+def read_source(
+    path: Path,
+    start: dt = None,
+    end: dt = None,
+    sum_ax1: bool = False,
+    columns: list = None,
+    cache_dir: Path = None,
+) -> pd.DataFrame:
+    """
+    Reads a .parquet source file and returns a DataFrame with the data between start and end dates (both
+    days included). The date range and the column subset are pushed down to pyarrow, so only the matching
+    row groups and columns are read. The index of the file (with its DateTime level) is kept.
+    With cache_dir (or the AMP_ARROW_CACHE environment variable), the source is read from a memory-mapped
+    Arrow IPC cache instead (see cached_table), which skips parquet decoding.
+    """
+    filters = []
+    if start is not None:
+        filters.append(("DateTime", ">=", pd.Timestamp(start).normalize()))
+    if end is not None:
+        filters.append(("DateTime", "<", pd.Timestamp(end).normalize() + pd.Timedelta(days=1)))
+
+    cache_dir = cache_dir or os.environ.get(CACHE_ENV)
+
+    if cache_dir is None:
+        source = pd.read_parquet(path, columns=columns, filters=filters or None)
+
+    else:
+        table = cached_table(path, cache_dir)
+        if filters:
+            table = table.filter(pq.filters_to_expression(filters))
+        if columns is not None: # keep the index columns, as pd.read_parquet does
+            index_cols = [c for c in table.schema.pandas_metadata["index_columns"] if isinstance(c, str)]
+            table = table.select([c for c in index_cols if c not in columns] + list(columns))
+        source = table.to_pandas()
+
+    if sum_ax1:
+        source = source.sum(axis=1)
+
+    return source
+
+
+def source_range(path: Path) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    First and last DateTime of a .parquet source, from the row group statistics when they are written
+    (so no data page is read), otherwise from the DateTime column only.
+    """
+    meta = pq.ParquetFile(path).metadata
+    col = meta.schema.names.index("DateTime")
+    stats = [meta.row_group(i).column(col).statistics for i in range(meta.num_row_groups)]
+
+    if all(s is not None and s.has_min_max for s in stats):
+        return pd.Timestamp(min(s.min for s in stats)), pd.Timestamp(max(s.max for s in stats))
+
+    dates = pq.read_table(path, columns=["DateTime"])["DateTime"].to_pandas()
+    return dates.min(), dates.max()
@@ -0,0 +1,178 @@
+"""
+
+On-disk memoization of the make_dataset stages. A stage output is stored as .parquet under a key that
+hashes the source code of the stage module and of amp_tests (the code the stages call), the fingerprints
+of its input data and its parameters, so unchanged stages are reloaded instead of recomputed. The cache is bounded in size (least recently used entries are evicted).
+
+Usage: python -m amp_tests.stage_cache {list,clear,evict} [--dir DIR] [--stage NAME] [--max-gb GB]
+
+"""
+
+import os
+import hashlib
+import inspect
+import argparse
+import functools
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+from amp_tests.utils import BidBook
+
+
+CACHE_DIR = Path(".stage_cache")
+MAX_BYTES = 20 * 2**30
+PACKAGE_DIR = Path(__file__).parent
+
+
+def fingerprint(obj) -> str:
+    """Content hash of a stage input: pandas objects and bid books are hashed by value, other objects by repr."""
+
+    h = hashlib.sha1()
+
+    if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        h.update(pd.util.hash_pandas_object(obj, index=not isinstance(obj, pd.Index)).to_numpy().tobytes())
+        if isinstance(obj, pd.DataFrame):
+            h.update(repr(list(obj.columns)).encode() + repr(obj.dtypes.tolist()).encode())
+        else:
+            h.update(repr(obj.dtype).encode())
+
+    elif isinstance(obj, BidBook):
+        h.update(fingerprint(obj.index).encode())
+        for a in (obj.price, obj.mw, obj.eco_max, obj.must_take):
+            h.update(np.ascontiguousarray(a).tobytes() if a is not None else b"None")
+        h.update(fingerprint(pd.Series(obj.status)).encode() if obj.status is not None else b"None")
+
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            h.update(fingerprint(o).encode())
+
+    elif isinstance(obj, dict):
+        for k in sorted(obj):
+            h.update(f"{k}={fingerprint(obj[k])}".encode())
+
+    else:
+        h.update(repr(obj).encode())
+
+    return h.hexdigest()
+
+
+@functools.lru_cache
+def code_version(module_file: str) -> str:
+    """
+    Hash of the source of a stage module and of all the amp_tests modules, so that a change in the code
+    a stage calls (e.g. ref_level or BidBook) also invalidates its cache entries.
+    """
+    h = hashlib.sha1()
+    for path in [Path(module_file), *sorted(PACKAGE_DIR.glob("*.py"))]:
+        h.update(path.name.encode() + path.read_bytes())
+    return h.hexdigest()
+
+
+def stage_key(func, *args, **params) -> str:
+    """Key of a stage call: hash of the stage code (see code_version), of the input fingerprints and of the parameters."""
+
+    h = hashlib.sha1(code_version(inspect.getsourcefile(func)).encode())
+    h.update(fingerprint(list(args)).encode())
+    h.update(fingerprint(params).encode())
+    return h.hexdigest()[:16]
+
+
+def cached_stage(
+    func,
+    *args,
+    cache_dir: Path = CACHE_DIR,
+    max_bytes: int = MAX_BYTES,
+    **params,
+) -> pd.DataFrame:
+    """
+    Returns func(*args, **params), reloaded from cache_dir if the same stage already ran on the same data
+    with the same parameters. Parameters should be passed by keyword so that they are part of the key
+    even when they equal the defaults. cache_dir=None disables the cache.
+    """
+
+    if cache_dir is None:
+        return func(*args, **params)
+
+    cache_dir = Path(cache_dir)
+    path = cache_dir / f"{func.__name__}-{stage_key(func, *args, **params)}.parquet"
+
+    if path.exists():
+        os.utime(path) # last use, for eviction
+        return pd.read_parquet(path)
+
+    res = func(*args, **params)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    res.to_parquet(tmp)
+    os.replace(tmp, path)
+    evict(cache_dir, max_bytes)
+
+    return res
+
+
+def list_entries(cache_dir: Path = CACHE_DIR) -> pd.DataFrame:
+    """Returns the cache entries with their stage, key, size and time of last use."""
+
+    entries = [
+        {
+            "stage": p.stem.rsplit("-", 1)[0],
+            "key": p.stem.rsplit("-", 1)[1],
+            "size_mb": p.stat().st_size / 2**20,
+            "last_used": datetime.fromtimestamp(p.stat().st_mtime),
+            "path": p,
+        }
+        for p in Path(cache_dir).glob("*.parquet")
+    ]
+    entries = pd.DataFrame(entries, columns=["stage", "key", "size_mb", "last_used", "path"])
+
+    return entries.sort_values("last_used", ascending=False, ignore_index=True)
+
+
+def evict(cache_dir: Path = CACHE_DIR, max_bytes: int = MAX_BYTES) -> list[Path]:
+    """Removes the least recently used entries until the cache is smaller than max_bytes. Returns the removed paths."""
+
+    entries = list_entries(cache_dir).iloc[::-1] # oldest first
+    total = entries["size_mb"].sum() * 2**20
+    removed = []
+
+    for _, entry in entries.iterrows():
+        if total <= max_bytes:
+            break
+        entry["path"].unlink(missing_ok=True)
+        total -= entry["size_mb"] * 2**20
+        removed.append(entry["path"])
+
+    return removed
+
+
+def clear(cache_dir: Path = CACHE_DIR, stage: str = None) -> list[Path]:
+    """Removes all the entries (of one stage if given). Returns the removed paths."""
+
+    entries = list_entries(cache_dir)
+    if stage is not None:
+        entries = entries[entries["stage"] == stage]
+    for p in entries["path"]:
+        p.unlink(missing_ok=True)
+
+    return list(entries["path"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and clear the make_dataset stage cache.")
+    parser.add_argument("command", choices=["list", "clear", "evict"])
+    parser.add_argument("--dir", type=Path, default=CACHE_DIR, help="cache directory")
+    parser.add_argument("--stage", default=None, help="only clear this stage (e.g. make_outcome)")
+    parser.add_argument("--max-gb", type=float, default=MAX_BYTES / 2**30, help="size bound for evict")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        entries = list_entries(args.dir)
+        print(entries.drop(columns="path").to_string(index=False))
+        print(f"Total: {entries['size_mb'].sum():.1f} MB in {len(entries)} entries.")
+
+    elif args.command == "clear":
+        print(f"Removed {len(clear(args.dir, stage=args.stage))} entries.")
+
+    elif args.command == "evict":
+        print(f"Removed {len(evict(args.dir, max_bytes=int(args.max_gb * 2**30)))} entries.")
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 
 
 def residual_supplier_index(
@@ -64,6 +65,85 @@ def pivotal_supplier_test(
     return pst
 
 
+def demand_definitions(
+    load: pd.Series,
+    reserves: pd.Series = None,
+    interchange: pd.Series = None,
+) -> dict[str, pd.Series]:
+    """Demand definitions of the residual supplier index: load only, plus reserves, plus interchange
+    (components are backward filled as in residual_supplier_index)."""
+
+    name, demand = "load", load.bfill()
+    demands = {name: demand}
+    for component, series in [("reserves", reserves), ("interchange", interchange)]:
+        if series is not None:
+            name, demand = f"{name}+{component}", demand + series.bfill()
+            demands[name] = demand
+
+    return demands
+
+
+
+def residual_supplier_indices(
+    bids: pd.DataFrame,
+    demands: dict[str, pd.Series],
+    group_by: list = ["Masked Lead Participant ID", "Masked Asset ID"],
+    substract_must_run: bool = True,
+    remove_unavailable: bool = True,
+    threshold: float = 1,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Computes the residual supplier index and the pivotal supplier test of every bid for several
+    supplier definitions (group_by: index levels, or lists of levels, grouped with DateTime) and
+    demand definitions (e.g. from demand_definitions) in one pass over the bids.
+    Hours and groups are encoded once as integer codes of the index levels and the capacities
+    are summed with np.bincount. Each bid gets the index of its group in its hour, as
+    bids.align(residual_supplier_index(...), join='left'): NaN if its group has no available bid.
+
+    Returns:
+        rsi (pd.DataFrame), pst (pd.DataFrame): indexed as bids, with columns (group, demand).
+    """
+
+    level = lambda name: bids.index.names.index(name)
+    hours, hour_codes = bids.index.levels[level("DateTime")], bids.index.codes[level("DateTime")]
+
+    avail = np.ones(len(bids), dtype=bool)
+    if remove_unavailable:
+        avail = (bids["Unit Status"] != "UNAVAILABLE").to_numpy()
+    avail_mw = bids["Economic Maximum"].to_numpy(dtype=float)
+    if substract_must_run:
+        # Remove must run bids from available capacity
+        avail_mw = avail_mw - bids["Must Take Energy"].to_numpy(dtype=float)
+    avail_mw = np.where(avail, np.nan_to_num(avail_mw), 0)
+
+    tot_mw = np.bincount(hour_codes, weights=avail_mw, minlength=len(hours))
+    has_bids = np.bincount(hour_codes, weights=avail, minlength=len(hours)) > 0
+    tot_mw = np.where(has_bids, tot_mw, np.nan)[hour_codes]
+    demand = {name: d.reindex(hours).to_numpy(dtype=float)[hour_codes] for name, d in demands.items()}
+
+    rsi = {}
+    for group in group_by:
+        group = [group] if isinstance(group, str) else list(group)
+        key = hour_codes.astype(np.int64)
+        for name in group:
+            key = key * (len(bids.index.levels[level(name)]) + 1) + bids.index.codes[level(name)] + 1
+        codes, uniques = pd.factorize(key)
+        supplier_mw = np.bincount(codes, weights=avail_mw, minlength=len(uniques))[codes]
+        in_group = np.bincount(codes, weights=avail, minlength=len(uniques))[codes] > 0
+        missing = np.column_stack([bids.index.codes[level(name)] < 0 for name in group]).any(axis=1)
+
+        for name, d in demand.items():
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = (tot_mw - supplier_mw) / d
+            rsi[(", ".join(group), name)] = np.where(in_group & ~missing, values, np.nan)
+
+    rsi = pd.DataFrame(rsi, index=bids.index)
+    rsi.columns.names = ["group", "demand"]
+    pst = rsi < threshold
+
+    return rsi, pst
+
+
+
 def congested_area_test(prices: pd.DataFrame) -> pd.Series:
     """Computes a series of boolean depending on whether an aread is congested (difference to
     Hub LMP >= 25 $/MWh) for any zonal node."""
@@ -1,6 +1,10 @@
-
+from __future__ import annotations
 import pandas as pd, numpy as np
 from scipy.stats import norm, bernoulli
+from dataclasses import dataclass
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 
 def fuzzy_prob(centered_x:list|np.ndarray, 
@@ -31,6 +35,65 @@ def fuzzy_treatment_assignment(centered_x:list|np.ndarray,
     return treat_assigned
 
 
+def _replicate_block(prob: np.ndarray, seeds: list[np.random.SeedSequence]) -> np.ndarray:
+    """Bit-packed treatment assignments of one block of replicates, one row per seed."""
+
+    block = np.empty((len(seeds), (len(prob) + 7) // 8), dtype=np.uint8)
+    for i, seed in enumerate(seeds):
+        block[i] = np.packbits(np.random.default_rng(seed).random(len(prob)) < prob)
+    return block
+
+
+def fuzzy_replicates(centered_x:list|np.ndarray, 
+                     n_replicates:int,
+                     std=0.1, # Uncertainty around the cutoff
+                     seed=None, # seed for reproducibility
+                     chunk_size:int=64, # replicates per block
+                     workers:int=1, # threads generating the blocks
+                     ) -> np.ndarray:
+    """
+    Draws n_replicates fuzzy treatment assignments of centered_x at once. The probabilities are computed
+    once and replicate r uses its own stream, spawned from seed (np.random.SeedSequence(seed).spawn), so the
+    result does not depend on chunk_size or workers. Returns the bit-packed (n_replicates, ceil(n / 8))
+    uint8 matrix, see unpack_replicates.
+    """
+
+    prob = fuzzy_prob(centered_x, std=std).ravel()
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+    chunks = [seeds[i : i + chunk_size] for i in range(0, n_replicates, chunk_size)]
+
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as executor: # numpy releases the GIL while drawing and packing
+            blocks = list(executor.map(partial(_replicate_block, prob), chunks))
+    else:
+        blocks = [_replicate_block(prob, chunk) for chunk in chunks]
+
+    return np.concatenate(blocks) if blocks else np.empty((0, (len(prob) + 7) // 8), dtype=np.uint8)
+
+
+def iter_fuzzy_replicates(centered_x:list|np.ndarray, 
+                          n_replicates:int,
+                          std=0.1, # Uncertainty around the cutoff
+                          seed=None, # seed for reproducibility
+                          chunk_size:int=64, # replicates per block
+                          ) -> Iterator[np.ndarray]:
+    """
+    Streaming version of fuzzy_replicates: yields the assignments as (chunk_size, n) uint8 blocks, so that
+    only one block is in memory. Rows are the same as the rows of unpack_replicates(fuzzy_replicates(...)).
+    """
+
+    prob = fuzzy_prob(centered_x, std=std).ravel()
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+
+    for i in range(0, n_replicates, chunk_size):
+        yield unpack_replicates(_replicate_block(prob, seeds[i : i + chunk_size]), len(prob))
+
+
+def unpack_replicates(packed:np.ndarray, n:int) -> np.ndarray:
+    """(n_replicates, n) uint8 treatment assignments of a bit-packed replicate matrix."""
+    return np.unpackbits(packed, axis=1, count=n)
+
+
 def sharp_treatment_assignment(centered_x: list|np.ndarray) -> np.ndarray: # Cutoff value for treatment assignment
 
     """
@@ -44,7 +107,7 @@ def sharp_treatment_assignment(centered_x: list|np.ndarray) -> np.ndarray: # Cut
 
 
 def get_incremental_bids(
-    bids: pd.DataFrame,
+    bids: pd.DataFrame|BidBook,
     p_floor: int = -150.0,
     p_ceil: int = 1000.0,
     must_run: bool = True,
@@ -55,22 +118,222 @@ def get_incremental_bids(
     Energy Offer Floor and Cap are defined by ISO-NE. Sources:
     https://www.iso-ne.com/participate/support/faq/emarket"""
 
-    if must_run: 
-        econ_bids = bids[bids["Unit Status"] != "UNAVAILABLE"]
-    else:
-        econ_bids = bids[bids["Unit Status"] == "ECONOMIC"]
-        
-    inc_bids = []
-
-    for i in range(1, 11):
-        segm_bids = econ_bids[[f"Segment {i} Price", f"Segment {i} MW"]]
-        segm_bids = segm_bids.rename(
-            columns={f"Segment {i} Price": "Price", f"Segment {i} MW": "MW"}
-        )
-        segm_bids = segm_bids.dropna(how="all", axis=0)
-        inc_bids.append(segm_bids)
-    inc_bids = pd.concat(inc_bids, axis=0)
-    inc_bids = inc_bids[(inc_bids["Price"] > p_floor) & (inc_bids["Price"] < p_ceil)]
+    book = as_bid_book(bids)
+    rows = np.flatnonzero(book.available(must_run))
+
+    # segment-major order, as concatenating the 10 segments one after the other
+    price, mw = book.price[rows].T.ravel(), book.mw[rows].T.ravel()
+    rows = np.tile(rows, book.price.shape[1])
+    keep = ~(np.isnan(price) & np.isnan(mw)) & (price > p_floor) & (price < p_ceil)
+    inc_bids = pd.DataFrame({"Price": price[keep], "MW": mw[keep]}, index=book.index[rows[keep]])
     #inc_bids["Price"] = inc_bids["Price"].clip(lower=p_floor, upper=p_ceil)
     
-    return inc_bids
\ No newline at end of file
+    return inc_bids
+
+
+
+def sort_by_hour(obj: pd.DataFrame|pd.Series, level: str = "DateTime") -> pd.DataFrame|pd.Series:
+    """Stable sort of a DataFrame or Series on its DateTime level, the order within each hour is kept."""
+
+    times = obj.index.get_level_values(level)
+    if times.is_monotonic_increasing:
+        return obj
+    return obj.iloc[np.argsort(times.values, kind="stable")]
+
+
+def exact_parts(x: np.ndarray) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Splits values into signed int64 digits of 26 bits on a fixed binary grid (from 2^52 to 2^-78), so that
+    sum(digit * 2^exponent) equals each value (up to its bits below 2^-78). Sums of digits are exact integers.
+    Yields (exponent, digits) from the most significant digit.
+    """
+    sign, rest = np.sign(x), np.abs(x)
+    for exponent in range(52, -79, -26):
+        digit = np.floor(np.ldexp(rest, -exponent))
+        rest = rest - np.ldexp(digit, exponent) # exact: digit * 2^exponent is rest truncated to the grid
+        yield exponent, (sign * digit).astype(np.int64)
+
+
+def grouped_rolling_mean(
+    values: pd.Series,
+    by: str|list,
+    windows: list[int],
+    lag: int = 0,
+    min_periods: int = None,
+) -> pd.DataFrame:
+    """
+    Rolling means of values over several windows at once, within the groups of the index levels by:
+    the column w equals values.groupby(level=by, group_keys=False).apply(lambda x: x.shift(lag).rolling(w,
+    min_periods).mean()), rows being in the same order as values. NaN values are skipped and counted as
+    missing for min_periods (default: the window length), as in pandas.
+    Values are sorted by group once and the window sums and counts are differences of prefix sums. The window
+    sum of each digit exponent of exact_parts is an exact integer, and these sums are added as floats from the
+    most significant digit (rounded at each of these few additions), so the mean of a window only depends on
+    the values in it, not on the rows before it (e.g. on how far back the history was read).
+    """
+
+    codes = values.groupby(level=by, sort=True).ngroup().fillna(-1).to_numpy(dtype=int)
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0] # rows with missing group keys are dropped, as by groupby
+    codes = codes[order]
+    x = values.to_numpy(dtype=float)[order]
+    valid = ~np.isnan(x)
+
+    n_groups = codes.max() + 1 if len(codes) else 0
+    first = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=n_groups))[:-1]])[codes]
+    counts = np.concatenate([[0], np.cumsum(valid)])
+
+    stop = np.arange(len(x)) - lag + 1 # window of row i: rows [stop - w, stop) of its group
+    bounds = {}
+    for w in windows:
+        start = np.maximum(stop - w, first)
+        bounds[w] = (start, np.maximum(stop, start))
+
+    sums = {w: np.zeros(len(x)) for w in windows}
+    for exponent, digits in exact_parts(np.where(valid, x, 0)):
+        prefix = np.concatenate([[0], np.cumsum(digits)])
+        for w, (start, end) in bounds.items():
+            sums[w] += np.ldexp((prefix[end] - prefix[start]).astype(float), exponent)
+
+    res = {}
+    for w, (start, end) in bounds.items():
+        count = counts[end] - counts[start]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums[w] / count
+        res[w] = np.where(count >= max(w if min_periods is None else min_periods, 1), mean, np.nan)
+
+    res = pd.DataFrame(res, index=values.index[order])
+
+    return res.iloc[np.argsort(order)] # back to the order of values
+
+
+def concat_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Positions of the ranges [starts[i], starts[i] + lengths[i]) one after the other."""
+    first = np.cumsum(lengths) - lengths # position of each range in the output
+    return np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+
+
+@dataclass
+class HourIndex:
+    """
+    CSR-style index over a frame sorted by DateTime: the rows of hours[i] are the
+    contiguous range offsets[i]:offsets[i + 1]. Built once, the rows of a set of hours
+    are then found from the offsets instead of by scanning all rows.
+    """
+
+    hours: pd.DatetimeIndex
+    offsets: np.ndarray
+
+    @classmethod
+    def from_index(cls, index: pd.Index, level: str = "DateTime") -> "HourIndex":
+        times = index.get_level_values(level)
+        if not times.is_monotonic_increasing:
+            raise ValueError(f"Index must be sorted by {level}, use sort_by_hour first.")
+        hours, starts = np.unique(times.values, return_index=True)
+        offsets = np.append(starts, len(times)).astype(np.int64)
+        return cls(hours=pd.DatetimeIndex(hours, name=level), offsets=offsets)
+
+    def __len__(self) -> int:
+        return len(self.hours)
+
+    def rows(self, hours: pd.DatetimeIndex) -> np.ndarray:
+        """Row positions of all the given hours (hours that are not indexed are ignored)."""
+        i = self.hours.get_indexer(hours)
+        i = i[i >= 0]
+        return concat_ranges(self.offsets[i], self.offsets[i + 1] - self.offsets[i])
+
+
+
+SEGMENTS = range(1, 11)
+
+
+@dataclass
+class BidBook:
+    """
+    Columnar representation of a bid table, built once per load and shared by the functions
+    that read segments (get_incremental_bids, ref_level, reference_levels, make_outcome, clearing).
+    Rows are sorted by DateTime (hour_ix gives the row range of each hour); price and mw are
+    contiguous (rows, 10) arrays, asset and participant are int32 codes into the index levels and
+    status is a categorical of the unit status (None if the bids have no status).
+    """
+
+    index: pd.MultiIndex
+    hour_ix: HourIndex
+    price: np.ndarray
+    mw: np.ndarray
+    asset: np.ndarray
+    participant: np.ndarray
+    status: pd.Categorical|None = None
+    eco_max: np.ndarray|None = None
+    must_take: np.ndarray|None = None
+
+    @classmethod
+    def from_bids(cls, bids: pd.DataFrame, dtype=np.float64) -> "BidBook":
+        """
+        Builds the bid book from a bid table indexed by DateTime, Masked Asset ID and Masked Lead Participant ID.
+        Values are float64 by default, so that results equal those computed on the table.
+        """
+
+        bids = sort_by_hour(bids)
+        index = bids.index
+        optional = lambda col: bids[col].to_numpy(dtype=dtype) if col in bids.columns else None
+
+        return cls(
+            index=index,
+            hour_ix=HourIndex.from_index(index),
+            price=bids[[f"Segment {s} Price" for s in SEGMENTS]].to_numpy(dtype=dtype),
+            mw=bids[[f"Segment {s} MW" for s in SEGMENTS]].to_numpy(dtype=dtype),
+            asset=index.codes[index.names.index("Masked Asset ID")].astype(np.int32),
+            participant=index.codes[index.names.index("Masked Lead Participant ID")].astype(np.int32),
+            status=pd.Categorical(bids["Unit Status"]) if "Unit Status" in bids.columns else None,
+            eco_max=optional("Economic Maximum"),
+            must_take=optional("Must Take Energy"),
+        )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def hour_codes(self) -> np.ndarray:
+        """Position in hour_ix.hours of the hour of each row."""
+        return np.repeat(np.arange(len(self.hour_ix), dtype=np.int32), np.diff(self.hour_ix.offsets))
+
+    def available(self, must_run: bool = True) -> np.ndarray:
+        """Rows of units that are not unavailable (must_run=True) or that are economic (must_run=False)."""
+        if self.status is None:
+            return np.ones(len(self), dtype=bool)
+        if must_run:
+            return np.asarray(self.status != "UNAVAILABLE")
+        return np.asarray(self.status == "ECONOMIC")
+
+    def to_frame(self) -> pd.DataFrame:
+        """Bid table of the book, in the layout of the bid files (segments, then the optional columns of the book)."""
+        columns = {}
+        for s in SEGMENTS:
+            columns[f"Segment {s} Price"] = self.price[:, s - 1]
+            columns[f"Segment {s} MW"] = self.mw[:, s - 1]
+        optional = {"Economic Maximum": self.eco_max, "Must Take Energy": self.must_take, "Unit Status": self.status}
+        columns.update({col: values for col, values in optional.items() if values is not None})
+        return pd.DataFrame(columns, index=self.index)
+
+    def take(self, rows: np.ndarray) -> "BidBook":
+        """Sub-book of the given rows (boolean mask or increasing positions, so rows stay sorted by hour)."""
+        index = self.index[rows]
+        optional = lambda a: a[rows] if a is not None else None
+
+        return BidBook(
+            index=index,
+            hour_ix=HourIndex.from_index(index),
+            price=self.price[rows],
+            mw=self.mw[rows],
+            asset=self.asset[rows],
+            participant=self.participant[rows],
+            status=optional(self.status),
+            eco_max=optional(self.eco_max),
+            must_take=optional(self.must_take),
+        )
+
+
+def as_bid_book(bids: pd.DataFrame|BidBook, dtype=np.float64) -> BidBook:
+    """Returns bids if it is already a BidBook, otherwise builds one."""
+    return bids if isinstance(bids, BidBook) else BidBook.from_bids(bids, dtype=dtype)
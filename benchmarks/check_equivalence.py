@@ -0,0 +1,264 @@
+"""
+
+Equivalence checks of the optimized and resumable paths of the simulation against their reference, on seeded
+synthetic data (see synthetic.py). Bids have many missing rows, so the reference levels of an asset reach
+further back than the reference period in calendar days, and prices are rounded to whole dollars, so offers
+tie. Each check prints the number of compared prices and of mismatches, and the script exits with 1 if any
+check fails.
+
+Usage (from the repository root):
+    python benchmarks/check_equivalence.py [--only resume shards reclear moc monte_carlo ...] [--seed 0]
+
+"""
+
+import sys
+import shutil
+import argparse
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent)) # add the path to the parent directory to sys.path
+from benchmarks.synthetic import make_bids, make_hourly, write_inputs
+from amp_tests.structural_test import residual_supplier_index
+from amp_tests.conduct_test import ref_level, mitigate_period
+from amp_tests.utils import BidBook, SEGMENTS
+from simulation.run_simulation import run_simulation, run_scenarios, moc_equilibrium
+from simulation.clearing import SupplyStack, clear_market, reclear_market, monte_carlo_prices
+from simulation.run_jobs import run_jobs
+warnings.filterwarnings('ignore')
+
+
+START, END = "2019-01-05", "2019-02-20" # simulated period, after about 3 months of bids
+SCENARIO = dict(rel_conduct_threshold=2, abs_conduct_threshold=50) # mitigates enough bids to move prices
+SCENARIOS = [SCENARIO, dict(structural_threshold=np.inf), dict(mitigate_conduct=False)]
+PRICES = [f"Segment {s} Price" for s in SEGMENTS]
+P_FLOOR, P_CEIL = -151, 1001 # price band of the clearing
+
+
+
+def mismatches(res: pd.Series|pd.DataFrame, ref: pd.Series|pd.DataFrame) -> dict:
+    """Number of compared values and of values that differ (NaN equals NaN), or of all values if the indexes differ."""
+    if not res.index.equals(ref.index) or np.shape(res) != np.shape(ref):
+        return {"compared": int(np.size(ref)), "mismatches": int(np.size(ref))}
+    equal = (res.to_numpy() == ref.to_numpy()) | (pd.isna(res).to_numpy() & pd.isna(ref).to_numpy())
+    return {"compared": int(equal.size), "mismatches": int(equal.size - equal.sum())}
+
+
+def input_folder(work: Path, seed: int) -> Path:
+    """Simulation inputs of about 6 months of bids of 60 assets, a quarter of the rows missing (written once)."""
+    folder = work / "input"
+    if not folder.exists():
+        write_inputs(folder, make_bids(60, 24 * 170, start="2018-09-01", missing=0.25, seed=seed), seed=seed)
+    return folder
+
+
+def offers(seed: int) -> tuple[pd.DataFrame, pd.Series]:
+    """
+    Bids of 3 weeks with whole-dollar prices (ties between offers) and a few offers outside of the price band,
+    and a demand with some hours that cannot be met and some without demand.
+    """
+
+    rng = np.random.default_rng(seed)
+    bids = make_bids(80, 24 * 21, missing=0.1, seed=seed)
+    price = bids[PRICES].to_numpy().round(0)
+    price[(rng.random(price.shape) < 0.02) & ~np.isnan(price)] = P_CEIL + 200
+    price[(rng.random(price.shape) < 0.01) & ~np.isnan(price)] = P_FLOOR - 50
+    bids[PRICES] = price
+    bids = bids.sort_index(level="DateTime", sort_remaining=False)
+
+    demand = make_hourly(bids, seed=seed)["load_fcst"]
+    scale = rng.choice([1, 3, 0], len(demand), p=[0.9, 0.07, 0.03]) # 3: demand not met, 0: no demand
+    demand = demand * scale
+    demand[rng.random(len(demand)) < 0.02] = np.nan
+
+    return bids, demand
+
+
+def mitigated_cases(bids: pd.DataFrame, demand: pd.Series, base: pd.Series, seed: int) -> dict[str, pd.DataFrame]:
+    """
+    Copies of bids with changed segment prices: the marginal offers (priced at the base price of their hour)
+    lowered, tied with cheaper offers or moved out of the band, offers from outside of the band moved below the
+    base price, random offers tied with the base price, and the mitigation of two scenarios.
+    """
+
+    rng = np.random.default_rng(seed)
+    price = bids[PRICES].to_numpy()
+    hour_base = base.reindex(bids.index.get_level_values("DateTime")).to_numpy()[:, None]
+    marginal = price == hour_base
+    outside = (price <= P_FLOOR) | (price >= P_CEIL)
+    some = rng.random(price.shape) < 0.05
+
+    def changed(mask, new):
+        mitigated = bids.copy()
+        mitigated[PRICES] = np.where(mask, new, price)
+        return mitigated
+
+    rsi = residual_supplier_index(bids, demand.fillna(0))
+    ref = ref_level(bids).reindex(bids.index)
+    cases = {
+        "marginal lowered": changed(marginal, price - 1),
+        "marginal tied": changed(marginal, np.round(price * 0.8)),
+        "marginal removed": changed(marginal, P_FLOOR - 1),
+        "marginal above band": changed(marginal, P_CEIL + 1),
+        "into band": changed(outside, np.broadcast_to(hour_base - 5, price.shape)),
+        "tied with base": changed(some & ~np.isnan(price), np.broadcast_to(hour_base, price.shape)),
+    }
+    for threshold, rel, abs_ref in [(1, 3, 100), (np.inf, 1.05, 1)]:
+        cases[f"mitigate_period {threshold}, {rel}, {abs_ref}"] = mitigate_period(
+            bids, rsi < threshold, ref, rel_ref=rel, abs_ref=abs_ref
+        )[0]
+
+    return cases
+
+
+def check_reclear(work: Path, seed: int) -> dict:
+    """
+    reclear_market gives the prices of clear_market on the mitigated bids: ties, changes at the marginal offer,
+    offers moved into or out of the price band, demand that cannot be met and hours without demand.
+    """
+
+    bids, demand = offers(seed)
+    book = BidBook.from_bids(bids)
+    stack = SupplyStack.from_bids(book, p_floor=P_FLOOR, p_ceil=P_CEIL)
+    demand = demand.reindex(stack.hours)
+    base = pd.Series(stack.clear(demand.to_numpy()), index=stack.hours)
+    result = {"compared": 0, "mismatches": 0}
+
+    for name, mitigated in mitigated_cases(bids, demand, base, seed).items():
+        ref = clear_market(mitigated, demand, p_floor=P_FLOOR, p_ceil=P_CEIL)
+        res = reclear_market(stack, base.to_numpy(), book, mitigated, demand, P_FLOOR, P_CEIL, max_changes=1)
+        counts = mismatches(res, ref)
+        print(f"  {name:<40} {counts['mismatches']:>6} of {counts['compared']} differ") if counts["mismatches"] else None
+        result = {k: result[k] + counts[k] for k in result}
+
+    return result
+
+
+def check_moc(work: Path, seed: int) -> dict:
+    """
+    clear_market (clear_offers, in this process and in a pool of workers, with hours in order or shuffled)
+    and SupplyStack.clear give the prices of moc_equilibrium hour by hour, on the bids of check_reclear
+    (hours without offers are left out, as moc_equilibrium fails on them).
+    """
+
+    bids, demand = offers(seed)
+    hours = bids.index.get_level_values("DateTime").unique()
+    demand = demand.reindex(hours)
+    ref = pd.Series([moc_equilibrium(bids.xs(h, level="DateTime", drop_level=False), demand[h]) for h in hours], index=hours)
+    stack = SupplyStack.from_bids(bids, hours, p_floor=P_FLOOR, p_ceil=P_CEIL)
+    hours = hours[np.diff(stack.offsets) > 0]
+    ref = ref[hours]
+
+    runs = {
+        "clear_market": clear_market(bids, demand[hours], p_floor=P_FLOOR, p_ceil=P_CEIL),
+        "clear_market workers=2": clear_market(bids, demand[hours], p_floor=P_FLOOR, p_ceil=P_CEIL, workers=2),
+        "clear_market shuffled": clear_market(
+            bids, demand[hours].sample(frac=1, random_state=seed), p_floor=P_FLOOR, p_ceil=P_CEIL, chunk_hours=50
+        ).reindex(hours),
+        "SupplyStack.clear": pd.Series(stack.clear(demand.to_numpy()), index=stack.hours)[hours],
+    }
+    result = {"compared": 0, "mismatches": 0}
+    for name, res in runs.items():
+        counts = mismatches(pd.Series(res.to_numpy(), index=hours), ref)
+        print(f"  {name:<40} {counts['mismatches']:>6} of {counts['compared']} differ") if counts["mismatches"] else None
+        result = {k: result[k] + counts[k] for k in result}
+
+    return result
+
+
+def check_monte_carlo(work: Path, seed: int) -> dict:
+    """
+    monte_carlo_prices on a stack built from shuffled hours (as the index of an unsorted load forecast) gives
+    the prices of clear_market: for a zero perturbation, and for each draw of relative perturbations per hour
+    and of absolute perturbations shared by all hours.
+    """
+
+    rng = np.random.default_rng(seed)
+    bids, demand = offers(seed)
+    load = demand.sample(frac=1, random_state=seed)
+    stack = SupplyStack.from_bids(bids, load.index, p_floor=P_FLOOR, p_ceil=P_CEIL, chunk_hours=50)
+    clear = lambda d: clear_market(bids, d, p_floor=P_FLOOR, p_ceil=P_CEIL).to_numpy()
+
+    relative = rng.normal(0, 0.05, (len(stack), 5))
+    absolute = rng.normal(0, 500, 5)
+    runs = {
+        "zero perturbation": (monte_carlo_prices(stack, load, np.zeros(1)), [clear(load)]),
+        "relative perturbations": (
+            monte_carlo_prices(stack, load, relative),
+            [clear(load * (1 + relative[:, j])) for j in range(relative.shape[1])],
+        ),
+        "absolute perturbations": (
+            monte_carlo_prices(stack, load, absolute, relative=False),
+            [clear(load + a) for a in absolute],
+        ),
+    }
+    result = {"compared": 0, "mismatches": 0}
+    for name, (res, ref) in runs.items():
+        counts = mismatches(res, pd.DataFrame(np.column_stack(ref), index=load.index))
+        print(f"  {name:<40} {counts['mismatches']:>6} of {counts['compared']} differ") if counts["mismatches"] else None
+        result = {k: result[k] + counts[k] for k in result}
+
+    return result
+
+
+def check_resume(work: Path, seed: int) -> dict:
+    """A run interrupted at an arbitrary hour and resumed from its checkpoints gives the prices of one run."""
+
+    folder = input_folder(work, seed)
+    ref = run_simulation(folder, START, END, verbose=False, **SCENARIO)
+    checkpoints = work / "checkpoints"
+    interrupt = pd.Timestamp(START) + (pd.Timestamp(END) - pd.Timestamp(START)) * 0.37 # not at a day boundary
+    run_simulation(folder, START, interrupt.floor("h"), verbose=False, checkpoint_dir=checkpoints, checkpoint_hours=100, **SCENARIO)
+    res = run_simulation(folder, START, END, verbose=False, checkpoint_dir=checkpoints, checkpoint_hours=100, **SCENARIO)
+
+    return mismatches(res, ref)
+
+
+def check_shards(work: Path, seed: int) -> dict:
+    """The merged prices.parquet of a sharded sweep (weekly shards) equals the prices of the unsharded sweep."""
+
+    folder = input_folder(work, seed)
+    ref = run_scenarios(folder, SCENARIOS, START, END, verbose=False)
+    run_jobs(folder, SCENARIOS, START, END, work / "jobs", freq="7D", workers=2)
+    res = pd.read_parquet(work / "jobs" / "prices.parquet")
+
+    return mismatches(res, ref)
+
+
+CHECKS = {
+    "resume": check_resume,
+    "shards": check_shards,
+    "reclear": check_reclear,
+    "moc": check_moc,
+    "monte_carlo": check_monte_carlo,
+}
+
+
+
+def run_checks(names: list[str] = None, seed: int = 0) -> bool:
+    """Runs the checks (all if names is None) on inputs generated with seed. Returns whether all passed."""
+
+    names = list(CHECKS) if names is None else names
+    work = Path(tempfile.mkdtemp())
+    try:
+        passed = True
+        for name in names:
+            result = CHECKS[name](work, seed)
+            passed &= result["mismatches"] == 0
+            print(f"{name:<24} {result['compared']:>8} compared {result['mismatches']:>6} mismatches")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return passed
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the optimized paths against their reference on synthetic data.")
+    parser.add_argument("--only", nargs="+", choices=list(CHECKS), default=None, help="only run these checks")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    args = parser.parse_args()
+
+    sys.exit(0 if run_checks(args.only, args.seed) else 1)
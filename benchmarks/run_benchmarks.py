@@ -0,0 +1,188 @@
+"""
+
+Benchmarks the hot paths of the tests, the dataset and the simulation on synthetic bids (see synthetic.py)
+at several scales. Each function is timed (best of --repeat runs) and its peak memory is measured in a
+separate run with tracemalloc (numpy and pandas buffers included). Results are saved as JSON with the
+commit they were run on, and two result files can be compared to find regressions.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py [--scales small medium] [--only ref_level ...] [--output FILE]
+    python benchmarks/run_benchmarks.py --compare OLD.json NEW.json [--tolerance 0.2]
+
+"""
+
+import sys
+import json
+import time
+import argparse
+import warnings
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime as dt
+sys.path.append(str(Path(__file__).parent.parent)) # add the path to the parent directory to sys.path
+from benchmarks.synthetic import make_bids, make_hourly
+from amp_tests.structural_test import residual_supplier_index, residual_supplier_indices, demand_definitions, pivotal_supplier_test
+from amp_tests.conduct_test import ref_level, reference_levels, mitigate_bids, mitigate_period
+from amp_tests.utils import get_incremental_bids, as_bid_book
+from simulation.run_simulation import moc_equilibrium
+from simulation.clearing import clear_market, reclear_market, SupplyStack
+from make_dataset import make_outcome, make_covariates
+warnings.filterwarnings('ignore')
+
+
+RESULTS = Path("benchmarks/results")
+
+# (number of assets, number of hours); "isone" is about the size of one year of ISO-NE real-time bids
+SCALES = {
+    "small": (50, 24 * 14),
+    "medium": (200, 24 * 90),
+    "large": (400, 24 * 180),
+    "isone": (350, 24 * 365),
+}
+
+
+
+def hourly_moc(bids, load_fcst, n_hours=24):
+    """moc_equilibrium is called hour by hour: benchmarks the first n_hours hours."""
+    hours = bids.index.get_level_values("DateTime").unique()[:n_hours]
+    return [moc_equilibrium(bids.xs(h, level="DateTime", drop_level=False), load_fcst[h]) for h in hours]
+
+
+# each benchmark maps the data of a scale (bids, hourly series and shared precomputations) to a call
+BENCHMARKS = {
+    "residual_supplier_index": lambda d: residual_supplier_index(d["bids"], d["load_fcst"], d["reserves"]),
+    "residual_supplier_indices": lambda d: residual_supplier_indices(
+        d["bids"], demand_definitions(d["load_fcst"], d["reserves"], d["net_imports"])
+    ),
+    "ref_level": lambda d: ref_level(d["bids"]),
+    "reference_levels": lambda d: reference_levels(d["bids"], d["hub_price"]),
+    "mitigate_bids": lambda d: mitigate_bids(d["bids"], d["pst"], d["ref_levels"], verbose=False),
+    "get_incremental_bids": lambda d: get_incremental_bids(d["bids"]),
+    "moc_equilibrium_24h": lambda d: hourly_moc(d["bids"], d["load_fcst"]),
+    "clear_market": lambda d: clear_market(d["bids"], d["load_fcst"]),
+    "reclear_market": lambda d: reclear_market(d["stack"], d["base"], d["book"], d["mitigated"], d["load_fcst"]),
+    "make_outcome": lambda d: make_outcome(d["bids"]),
+    "make_covariates": lambda d: make_covariates(
+        d["bids"], d["load_fcst"], d["gas_prices"], d["wind_fcst"],
+        d["net_imports"], d["da_must_take"], d["temperature"],
+    ),
+}
+
+
+
+def scale_data(n_assets: int, n_hours: int, seed: int = 0) -> dict:
+    """Synthetic bids and hourly series of a scale, with the inputs of mitigate_bids and reclear_market precomputed."""
+
+    bids = make_bids(n_assets, n_hours, seed=seed)
+    data = {"bids": bids, **make_hourly(bids, seed=seed)}
+    data["pst"] = pivotal_supplier_test(bids, data["load_fcst"], data["reserves"])
+    data["ref_levels"] = ref_level(bids)
+    data["book"] = as_bid_book(bids)
+    data["stack"] = SupplyStack.from_bids(data["book"])
+    data["base"] = data["stack"].clear(data["load_fcst"].reindex(data["stack"].hours).to_numpy())
+    data["mitigated"] = mitigate_period(bids, data["pst"], data["ref_levels"].reindex(bids.index))[0]
+
+    return data
+
+
+def measure(call, data: dict, repeat: int = 3) -> dict:
+    """Best wall time of repeat runs, then peak traced memory of one more run (tracing slows the run down)."""
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call(data)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    call(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": min(seconds), "peak_mb": peak / 2**20}
+
+
+def git_commit() -> dict:
+    """Commit of the working tree and whether it has uncommitted changes."""
+    run = lambda *args: subprocess.run(["git", *args], capture_output=True, text=True).stdout.strip()
+    return {"commit": run("rev-parse", "HEAD") or None, "dirty": bool(run("status", "--porcelain", "--untracked-files=no"))}
+
+
+def run_benchmarks(scales: list[str], names: list[str] = None, repeat: int = 3, seed: int = 0) -> dict:
+    """Runs the benchmarks (all if names is None) at each scale. Returns the results with their environment."""
+
+    names = list(BENCHMARKS) if names is None else names
+    report = {
+        **git_commit(),
+        "date": dt.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "seed": seed,
+        "results": [],
+    }
+
+    for scale in scales:
+        n_assets, n_hours = SCALES[scale]
+        data = scale_data(n_assets, n_hours, seed)
+        print(f"{scale}: {n_assets} assets, {n_hours} hours, {len(data['bids'])} bids")
+
+        for name in names:
+            result = measure(BENCHMARKS[name], data, repeat)
+            report["results"].append(
+                {"scale": scale, "function": name, "n_assets": n_assets, "n_hours": n_hours,
+                 "n_bids": len(data["bids"]), **result}
+            )
+            print(f"  {name:<28} {result['seconds']:>9.3f} s {result['peak_mb']:>10.1f} MB")
+
+    return report
+
+
+def compare(old: dict, new: dict, tolerance: float = 0.2) -> pd.DataFrame:
+    """
+    Ratios new / old of the time and peak memory of the benchmarks in both results, with a regression flag
+    where the time or memory grew by more than tolerance.
+    """
+
+    key = ["scale", "function"]
+    old_df = pd.DataFrame(old["results"]).set_index(key)[["seconds", "peak_mb"]]
+    new_df = pd.DataFrame(new["results"]).set_index(key)[["seconds", "peak_mb"]]
+    df = old_df.join(new_df, how="inner", lsuffix="_old", rsuffix="_new")
+
+    df["time_ratio"] = df["seconds_new"] / df["seconds_old"]
+    df["memory_ratio"] = df["peak_mb_new"] / df["peak_mb_old"]
+    df["regression"] = (df["time_ratio"] > 1 + tolerance) | (df["memory_ratio"] > 1 + tolerance)
+
+    return df
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths on synthetic bids.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small", "medium"], help="scales to run")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=None, help="only run these benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark (the best is kept)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--output", type=Path, default=None, help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, type=Path, metavar=("OLD", "NEW"), help="compare two results files")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative growth flagged as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = (json.loads(path.read_text()) for path in args.compare)
+        print(f"{(old['commit'] or '')[:10]} -> {(new['commit'] or '')[:10]}")
+        df = compare(old, new, args.tolerance)
+        print(df.round(3).to_string())
+        sys.exit(int(df["regression"].any()))
+
+    report = run_benchmarks(args.scales, args.only, args.repeat, args.seed)
+    output = args.output or RESULTS / f"{(report['commit'] or 'nocommit')[:10]}{'-dirty' if report['dirty'] else ''}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Results saved to {output}")
@@ -0,0 +1,126 @@
+"""
+
+Seeded synthetic market data with the schema of the real ISO-NE inputs, for benchmarks.
+Bids are indexed by (DateTime, Masked Asset ID, Masked Lead Participant ID) and have the columns
+Segment 1..10 Price/MW, Economic Maximum, Must Take Energy and Unit Status.
+
+"""
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+SEGMENTS = range(1, 11)
+
+
+def make_bids(
+    n_assets: int = 100,
+    n_hours: int = 24 * 30,
+    n_participants: int = None,
+    start: str = "2019-01-01",
+    missing: float = 0.03,  # share of (hour, asset) rows without a bid
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Bid table of n_assets units over n_hours hours. Each unit has a participant, a base price and a capacity;
+    every hour it bids 1 to 10 segments with increasing prices (a few bids are far above the base price).
+    Returns pd.DataFrame sorted by DateTime, in the layout of the rt_bids parquet files.
+    """
+
+    rng = np.random.default_rng(seed)
+    n_participants = n_participants or max(1, n_assets // 5)
+    hours = pd.date_range(start, periods=n_hours, freq="h", name="DateTime")
+    assets = 10000 + np.arange(n_assets)
+    participants = 500 + rng.integers(0, n_participants, n_assets)
+
+    # unit characteristics
+    base = rng.uniform(5, 80, n_assets)
+    capacity = rng.uniform(20, 800, n_assets)
+    must_run = rng.random(n_assets) < 0.15
+
+    keep = rng.random(n_hours * n_assets) >= missing
+    hour_ix = np.repeat(np.arange(n_hours), n_assets)[keep]
+    unit = np.tile(np.arange(n_assets), n_hours)[keep]
+    n = len(unit)
+
+    n_segments = rng.integers(1, 11, n)
+    active = np.arange(10)[None, :] < n_segments[:, None]
+    price = base[unit, None] + np.cumsum(rng.exponential(6, (n, 10)), axis=1)
+    price[rng.random(n) < 0.01, -3:] *= 15 # a few offers far above the reference level
+    mw = capacity[unit, None] / n_segments[:, None] * rng.uniform(0.8, 1.2, (n, 10))
+    price = np.where(active, np.round(price, 2), np.nan)
+    mw = np.where(active, np.round(mw, 1), np.nan)
+
+    status = np.where(must_run[unit], "MUST_RUN", "ECONOMIC").astype(object)
+    status[rng.random(n) < 0.08] = "UNAVAILABLE"
+    must_take = np.where(must_run[unit], np.round(capacity[unit] * rng.uniform(0.1, 0.4, n), 1), 0.0)
+
+    columns = {}
+    for s in SEGMENTS:
+        columns[f"Segment {s} Price"] = price[:, s - 1]
+        columns[f"Segment {s} MW"] = mw[:, s - 1]
+    columns["Economic Maximum"] = np.round(capacity[unit], 1)
+    columns["Must Take Energy"] = must_take
+    columns["Unit Status"] = status
+
+    index = pd.MultiIndex.from_arrays(
+        [hours[hour_ix], assets[unit], participants[unit]],
+        names=["DateTime", "Masked Asset ID", "Masked Lead Participant ID"],
+    )
+
+    return pd.DataFrame(columns, index=index)
+
+
+def make_hourly(bids: pd.DataFrame, seed: int = 0) -> dict:
+    """
+    Hourly (and daily) series over the hours of bids, scaled to the offered capacity so that the market clears:
+    load forecast, reserves, net imports, wind forecast, temperature, hub price, day-ahead must take and gas prices.
+    """
+
+    rng = np.random.default_rng(seed)
+    hours = bids.index.get_level_values("DateTime").unique().sort_values()
+    capacity = bids["Economic Maximum"].groupby("DateTime").sum().reindex(hours).to_numpy()
+    daily = np.sin(2 * np.pi * (hours.hour.to_numpy() - 6) / 24)
+
+    load = capacity * (0.55 + 0.15 * daily + rng.normal(0, 0.03, len(hours)))
+    days = pd.date_range(hours[0].normalize(), hours[-1].normalize(), freq="D", name="DateTime")
+    series = lambda values, name: pd.Series(values, index=hours, name=name)
+
+    return {
+        "load_fcst": series(load, "load_forecast"),
+        "reserves": series(capacity * 0.05, "reserves"),
+        "net_imports": series(rng.normal(0.05, 0.02, len(hours)) * capacity, "net_imports"),
+        "wind_fcst": series(rng.uniform(0, 0.05, len(hours)) * capacity, "Wind"),
+        "temperature": series(10 + 10 * daily + rng.normal(0, 2, len(hours)), "AverageTemperature"),
+        "hub_price": series(40 + 20 * daily + rng.normal(0, 5, len(hours)), ".H.Internal_Hub"),
+        "da_must_take": bids["Must Take Energy"].groupby("DateTime").sum().rename("da_must_take"),
+        "gas_prices": pd.DataFrame({"Price": rng.uniform(2, 9, len(days))}, index=days),
+    }
+
+
+def write_inputs(folder, bids: pd.DataFrame, seed: int = 0) -> Path:
+    """
+    Writes bids and their hourly series (make_hourly) as the input files of simulation/run_simulation.py
+    (rt_bids, rt_prices, load_forecast, reserves and mitigated_hours of 2018-2019). Returns the folder.
+    """
+
+    rng = np.random.default_rng(seed)
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    hourly = make_hourly(bids, seed=seed)
+    hours = hourly["load_fcst"].index
+    zones = [".Z.Connecticut", ".Z.Maine"]
+
+    prices = pd.DataFrame({".H.Internal_Hub": hourly["hub_price"]})
+    for z in zones: # a few congested hours (zonal price 25 $/MWh above the hub)
+        prices[z] = prices[".H.Internal_Hub"] + np.where(rng.random(len(hours)) < 0.02, 30, rng.normal(0, 3, len(hours)))
+    flags = pd.DataFrame({"Day-Ahead mitigated?": False, "Real-Time mitigated?": rng.random(len(hours)) < 0.01}, index=hours)
+
+    bids.to_parquet(folder / "rt_bids_2018-2019.parquet")
+    prices.to_parquet(folder / "rt_prices_2018-2019.parquet")
+    pd.DataFrame({z: hourly["load_fcst"] / len(zones) for z in zones}).to_parquet(folder / "load_forecast_2018-2019.parquet")
+    hourly["reserves"].to_frame("7000").to_parquet(folder / "reserves_2018-2019.parquet")
+    flags.to_parquet(folder / "mitigated_hours_2018-2019.parquet")
+
+    return folder
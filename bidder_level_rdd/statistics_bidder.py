@@ -5,54 +5,69 @@ Here we compute the bidder-level statistics for NYISO and ISO-NE data.
 
 """
 
+import sys
 import pandas as pd
 import warnings
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(str(Path(__file__).parent.parent)) # add the path to the parent directory to sys.path
+from amp_tests.sources import read_source
 warnings.filterwarnings('ignore')
 
 
 
-    
+
 def compute_statistics(dataset):
 
-    stats = ["num_units", 
+    stats = ["num_units",
              "median_volume",
-             "avg_volume", 
+             "avg_volume",
              "median_bid",
-             "avg_bid", 
+             "avg_bid",
              "std_bid"]
-    stats_df = pd.DataFrame(columns=stats)
-
-    for (b, bidder_df) in dataset.groupby("bidder"):
-        groupby_df = bidder_df.groupby("datetime")
-        # max number of bidding units per datetime
-        stats_df.loc[b, "num_units"] = groupby_df["unit"].nunique().max()
-        # median / avg total bid volume by datetime
-        stats_df.loc[b, "median_volume"] = groupby_df["asset_mw"].sum().median()
-        stats_df.loc[b, "avg_volume"] = groupby_df["asset_mw"].sum().mean()
-        # median / avg / std of bids in the dataset
-        stats_df.loc[b, "median_bid"] = bidder_df["max_bid"].median()
-        stats_df.loc[b, "avg_bid"] = bidder_df["max_bid"].mean()
-        stats_df.loc[b, "std_bid"] = bidder_df["max_bid"].std()
-    
+
+    # number of bidding units and total bid volume of each bidder by datetime
+    by_datetime = dataset.groupby(["bidder", "datetime"]).agg(num_units=("unit", "nunique"),
+                                                              volume=("asset_mw", "sum"))
+    # max number of units, median / avg total bid volume by datetime
+    by_bidder = by_datetime.groupby("bidder").agg(num_units=("num_units", "max"),
+                                                  median_volume=("volume", "median"),
+                                                  avg_volume=("volume", "mean"))
+    # median / avg / std of bids in the dataset
+    bids = dataset.groupby("bidder")["max_bid"].agg(median_bid="median", avg_bid="mean", std_bid="std")
+
+    stats_df = pd.concat([by_bidder, bids], axis=1)[stats]
+    stats_df.index.name = None
+
     return stats_df
 
 
-        
 
+def market_statistics(path, market, year=2019):
+    """Reads the columns and rows (year) needed from the dataset of a market, computes and saves its bidder statistics."""
 
-if __name__ == "__main__":
+    df = read_source(path / f"2025-08-12_{market}_dataset.parquet",
+                     start=f"{year}-01-01", end=f"{year}-12-31",
+                     columns=["max_bid", "asset_mw"])
+    df = df.reset_index()
+    df = df.rename(columns={"DateTime": "datetime",
+                            "Masked Lead Participant ID": "bidder",
+                            "Masked Asset ID": "unit"})
 
-    path = Path("data")
+    stats = compute_statistics(df)
+    stats.to_excel(path / f"{market}_bidder_stats.xlsx")
+
+    return stats
 
-    for market in ["iso-ne", "nyiso"]:
 
-        df = pd.read_parquet(path / f"2025-08-12_{market}_dataset.parquet")
-        df = df[df.index.get_level_values('DateTime').year == 2019]
-        df = df.reset_index()
-        df = df.rename(columns={"DateTime": "datetime", 
-                                "Masked Lead Participant ID": "bidder", 
-                                "Masked Asset ID": "unit"})
 
-        stats = compute_statistics(df)
-        stats.to_excel(path / f"{market}_bidder_stats.xlsx")
+
+
+if __name__ == "__main__":
+
+    path = Path("data")
+    markets = ["iso-ne", "nyiso"]
+
+    # markets are processed concurrently, in separate processes
+    with ProcessPoolExecutor(len(markets)) as executor:
+        list(executor.map(market_statistics, [path] * len(markets), markets))
@@ -1,44 +1,63 @@
 import pandas as pd
-from amp_tests.structural_test import residual_supplier_index
+import numpy as np
+from amp_tests.structural_test import residual_supplier_indices
+from amp_tests.conduct_test import ref_level, ref_level_state, append_ref_level
+from amp_tests.utils import BidBook, as_bid_book
+from amp_tests.sources import read_source, source_range
+from amp_tests.stage_cache import cached_stage
+from amp_tests.instrumentation import Instrumentation
+import argparse
+from dataclasses import dataclass
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 from datetime import datetime
 
 
-def offer_based_ref(x, days):
-    ref = x.shift(24).rolling(days * 24, min_periods=1).mean() #adding min_periods=1 to avoid NaN
-    return ref
-
-
-def make_outcome(bids:pd.DataFrame) -> pd.DataFrame:
+def make_outcome(bids:pd.DataFrame|BidBook, days=90, min_bid=0, max_bid=800) -> pd.DataFrame:
     """
-    Computes max bid and reference levels.
+    Computes max bid and reference levels (rolling average over days of the bids within (min_bid, max_bid)).
     Returns pd.DataFrame with index [DateTime, Masked Asset ID, Masked Lead Participant ID].
     """
-    bids = bids.copy()
-    bids = bids.sort_index(level="DateTime")
-    if 'Unit Status' in bids.columns: # for NYISO, unit status are unclear
-        bids = bids[bids["Unit Status"] != "UNAVAILABLE"]
+    book = as_bid_book(bids) # sorted by DateTime
+    if book.status is not None: # for NYISO, unit status are unclear
+        book = book.take(book.available(must_run=True))
 
-    price = bids.filter(regex='Segment [0-9]+ Price')
-    mw = bids.filter(regex='Segment [0-9]+ MW')
-    price = price.rename(columns={c: i for i, c in enumerate(price.columns)})
-    mw = mw.rename(columns={c: i for i, c in enumerate(mw.columns)})
-    max_bid = price.max(axis=1)
-    
-    for col in mw.columns: # considers only bids within bounds
-        mw[col] = mw[col].where(price[col] > 0, other=0)
-        mw[col] = mw[col].where(price[col] < 800, other=0)
-    
-    avg_bid = (price * mw).sum(axis=1) / mw.sum(axis=1)   
-    avg_group = avg_bid.groupby("Masked Asset ID", group_keys=False)
-    ref_level = avg_group.apply(lambda x: offer_based_ref(x, 90))
-    dep_vars = pd.concat([max_bid, ref_level], axis=1)
+    max_price = pd.Series(np.fmax.reduce(book.price, axis=1), index=book.index, dtype=float)
+    ref = ref_level(book, min_bid=min_bid, max_bid=max_bid, days=days) # considers only bids within bounds
+    dep_vars = pd.concat([max_price, ref], axis=1)
     dep_vars.columns = ['max_bid', 'ref_level']
     
     return dep_vars
 
 
 
+def make_outcome_chunk(bids:pd.DataFrame|BidBook, 
+                       state:pd.Series=None, 
+                       days=90, min_bid=0, max_bid=800
+                       ) -> tuple[pd.DataFrame, pd.Series]:
+    """
+    Same as make_outcome for the bids of one chunk of hours, the reference levels being continued from the
+    state of the previous chunks (see append_ref_level). Without state, the chunk is the start of the history.
+    Returns the outcome variables of the chunk and the state for the next chunk.
+    """
+    book = as_bid_book(bids)
+    if book.status is not None:
+        book = book.take(book.available(must_run=True))
+
+    max_price = pd.Series(np.fmax.reduce(book.price, axis=1), index=book.index, dtype=float)
+    if state is None:
+        ref = ref_level(book, min_bid=min_bid, max_bid=max_bid, days=days)
+        state = ref_level_state(book, min_bid=min_bid, max_bid=max_bid, days=days)
+    else:
+        ref, state = append_ref_level(state, book)
+    dep_vars = pd.concat([max_price, ref], axis=1)
+    dep_vars.columns = ['max_bid', 'ref_level']
+
+    return dep_vars, state
+
+
+
 def make_pivotality_treatment(bids:pd.DataFrame, 
                    load_fcst: pd.DataFrame, 
                    reserves: pd.DataFrame|int=0
@@ -48,10 +67,11 @@ def make_pivotality_treatment(bids:pd.DataFrame,
     Returns: pd.DataFrame with index [DateTime, Masked Asset ID, Masked Lead Participant ID].
     """
 
-    rsi = residual_supplier_index(bids, load_fcst, 
-                                  reserves, 
-                                  substract_must_run=True)
-    _, rsi = bids.align(rsi, axis=0, join='left')
+    demand = load_fcst.bfill() + (reserves.bfill() if isinstance(reserves, pd.Series) else reserves)
+    rsi, _ = residual_supplier_indices(bids, {'demand': demand}, 
+                                       group_by=['Masked Lead Participant ID'], 
+                                       substract_must_run=True)
+    rsi = rsi.iloc[:, 0] # rsi of the participant of each bid
     pst = (rsi > 1).astype(int)
     treat_vars = pd.concat([rsi, pst], axis=1)
     treat_vars.columns = ['rsi', 'is_not_pivotal']
@@ -61,32 +81,77 @@ def make_pivotality_treatment(bids:pd.DataFrame,
 
 
 
-def make_congestion_treatment(rt_cong:pd.DataFrame,
-                              load_fcst:pd.Series) -> pd.DataFrame:
+def congestion_scores(rt_cong:pd.DataFrame, load_fcst:pd.DataFrame) -> dict[str, pd.Series]:
     """
-    Computes treatment variables for congestion for day-ahead and real-time markets.
-    Returns: pd.DataFrame with index [DateTime].
+    Computes the hourly congestion scores: load-weighted average ('avg_cong') and maximum ('max_cong')
+    of the zonal shadow prices. Each score keeps its own index (the max only covers the hours of rt_cong).
     """
     #ignore nyc because it is always considered a constrained area
     load_zones = ['capitl', 'centrl', 'dunwod', 'genese', 'hudvl', 'longil', 'mhkvl', 'millwd', 'north', 'west']
     load_fcst, rt_cong = load_fcst.copy()[load_zones], rt_cong.copy()[load_zones]
     rel_load = load_fcst[load_zones].div(load_fcst[load_zones].sum(axis=1), axis=0)
-    cong_dict = {}
-  
     cong_zones = rt_cong * rel_load
-    cong_dict = {'avg_cong': cong_zones.sum(axis=1),
-                 'max_cong': rt_cong.max(axis=1),
-                 'avg_cong_1h_lag': cong_zones.sum(axis=1).shift(1),
-                 'max_cong_1h_lag': rt_cong.max(axis=1).shift(1),
-                 'avg_cong_3h_lag': cong_zones.sum(axis=1).shift(3),
-                 'max_cong_3h_lag': rt_cong.max(axis=1).shift(3)}
+
+    return {'avg_cong': cong_zones.sum(axis=1), 'max_cong': rt_cong.max(axis=1)}
+
+
+
+@dataclass
+class CongestionCube:
+    """
+    Congestion treatment indicators (score > cutoff) of every score for a grid of cutoffs and lags (hours),
+    bit-packed along the hours: bits[name][i, j] are the packed indicators of cutoffs[i] and lags[j] over the
+    hours of scores[name]. Single (cutoff, lag) columns are materialized with score and treatment.
+    """
+
+    scores: dict[str, pd.Series]
+    cutoffs: np.ndarray
+    lags: np.ndarray
+    bits: dict[str, np.ndarray]
+
+    @classmethod
+    def from_scores(cls, scores:dict[str, pd.Series], cutoffs:list[float], lags:list[int]) -> "CongestionCube":
+        cutoffs, lags = np.asarray(cutoffs, dtype=float), np.asarray(lags, dtype=int)
+        bits = {}
+        for name, score in scores.items():
+            lagged = np.stack([score.shift(lag).to_numpy(dtype=float) for lag in lags]) # (lags, hours)
+            with np.errstate(invalid='ignore'): # NaN scores are not treated
+                bits[name] = np.stack([np.packbits(lagged > cutoff, axis=-1) for cutoff in cutoffs])
+
+        return cls(scores=scores, cutoffs=cutoffs, lags=lags, bits=bits)
+
+    @staticmethod
+    def column(name:str, lag:int) -> str:
+        return name if lag == 0 else f'{name}_{lag}h_lag'
+
+    def score(self, name:str, lag:int=0) -> pd.Series:
+        """Score lagged by lag hours."""
+        return self.scores[name].shift(lag).rename(self.column(name, lag))
+
+    def treatment(self, name:str, cutoff:float, lag:int=0, dtype=np.uint8) -> pd.Series:
+        """Treatment indicator of a (cutoff, lag) pair of the grid."""
+        i, j = np.flatnonzero(np.isclose(self.cutoffs, cutoff)), np.flatnonzero(self.lags == lag)
+        if len(i) == 0 or len(j) == 0:
+            raise KeyError(f'({cutoff}, {lag}) is not in the grid of cutoffs and lags.')
+        score = self.scores[name]
+        treated = np.unpackbits(self.bits[name][i[0], j[0]], count=len(score))
+        return pd.Series(treated.astype(dtype), index=score.index, name=f'is_{self.column(name, lag)}')
+
+
+
+def make_congestion_treatment(rt_cong:pd.DataFrame,
+                              load_fcst:pd.Series,
+                              cutoff:float=0.04) -> pd.DataFrame:
+    """
+    Computes treatment variables for congestion for day-ahead and real-time markets (treated if score > cutoff).
+    Returns: pd.DataFrame with index [DateTime].
+    """
+    cube = CongestionCube.from_scores(congestion_scores(rt_cong, load_fcst), cutoffs=[cutoff], lags=[0, 1, 3])
     
     treat_vars = []
-    for name, score in cong_dict.items():
-        score = score.rename(name)
-        treatment = (score > 0.04).astype(int)
-        treatment.name = f'is_{name}'
-        treat_vars.extend([score, treatment])
+    for lag in cube.lags:
+        for name in cube.scores:
+            treat_vars.extend([cube.score(name, lag), cube.treatment(name, cutoff, lag, dtype=int)])
     
     treat_vars = pd.concat(treat_vars, axis=1)
     
@@ -101,6 +166,7 @@ def make_covariates(bids:pd.DataFrame,
                     net_imports:pd.Series,
                     da_must_take:pd.Series,
                     temperature:pd.Series,
+                    time_dummies:str='uint8',
                     ) -> pd.DataFrame:
     """
     Add covariates for the regression and the cluster analysis:
@@ -111,6 +177,10 @@ def make_covariates(bids:pd.DataFrame,
         - time dummies
         - economic maximum (asset_mw)
         - economic maximum (company_mw)
+
+    Hourly covariates are broadcast to the bids by gathering with the DateTime codes of the bid index.
+    time_dummies sets how hour and quarter are encoded: 'uint8' (one uint8 column per hour and quarter),
+    'category' (two categorical columns) or 'codes' (two uint8 columns of hour and quarter numbers).
     
     Returns: pd.DataFrame with index [DateTime, Masked Asset ID, Masked Lead Participant ID].
     """
@@ -121,71 +191,213 @@ def make_covariates(bids:pd.DataFrame,
     res_load = (load_fcst - wind_fcst - net_imports).rename('res_load')
     covs = pd.concat([load_fcst, res_load, da_must_take, gas, temperature], axis=1)
     covs.columns = ['load_fcst', 'res_load', 'da_must_take', 'gas_prices', 'temperature']
-    _, covs = bids.align(covs, axis=0, join='left')
 
-    asset_mw = bids['Economic Maximum'].rename('asset_mw')
-    company_mw = bids.groupby(['DateTime','Masked Lead Participant ID'])['Economic Maximum'].sum()
-    _,company_mw = bids.align(company_mw.rename('company_mw'), axis=0, join='left')
-    covs = pd.concat([covs, asset_mw, company_mw], axis=1)
+    # hour and participant of each bid as codes into the index levels
+    level = lambda name: bids.index.names.index(name)
+    hours, hour_codes = bids.index.levels[level('DateTime')], bids.index.codes[level('DateTime')]
+    part_codes = bids.index.codes[level('Masked Lead Participant ID')]
+    covs = pd.DataFrame(covs.reindex(hours).to_numpy()[hour_codes], columns=covs.columns, index=bids.index)
+
+    # company_mw: sum of the economic maximum of each (hour, participant), gathered back to the bids
+    eco_max = bids['Economic Maximum'].to_numpy(dtype=float)
+    n_parts = len(bids.index.levels[level('Masked Lead Participant ID')])
+    company_codes, companies = pd.factorize(hour_codes.astype(np.int64) * n_parts + part_codes)
+    company_mw = np.bincount(company_codes, weights=np.nan_to_num(eco_max), minlength=len(companies))
+    covs['asset_mw'] = eco_max
+    covs['company_mw'] = np.where(part_codes >= 0, company_mw[company_codes], np.nan)
     
-    index = bids.index.to_frame(index=True)
+    if time_dummies not in ('uint8', 'category', 'codes'):
+        raise ValueError(f"time_dummies must be 'uint8', 'category' or 'codes', got {time_dummies}.")
     
-    for freq in ['hour', 'quarter']: 
-        time = getattr(index['DateTime'].dt, freq)
-        dummies = pd.get_dummies(time, prefix=freq, 
-                                drop_first=False)
-        dummies = dummies.set_index(covs.index).astype(int)
-        covs = pd.concat([covs, dummies], axis=1)   
+    time = []
+    for freq, categories in [('hour', range(24)), ('quarter', range(1, 5))]:
+        codes = getattr(hours, freq).to_numpy().astype(np.uint8)[hour_codes]
+        if time_dummies == 'uint8': # fixed categories, so that every chunk has the same columns
+            dummies = (codes[:, None] == np.array(categories, dtype=np.uint8)).view(np.uint8)
+            time.append(pd.DataFrame(dummies, columns=[f'{freq}_{c}' for c in categories], index=bids.index))
+        elif time_dummies == 'category':
+            time.append(pd.Series(pd.Categorical(codes, categories=categories), name=freq, index=bids.index))
+        else:
+            time.append(pd.Series(codes, name=freq, index=bids.index))
     
+    covs = pd.concat([covs, *time], axis=1)
     covs = covs.dropna(how='any', axis=0)
 
     return covs
 
-git 
 
-if __name__ == "__main__":
-    PATH = 'data'
-    MARKET = 'ISO-NE' # 'ISO-NE' or 'NYISO'
-    rt_bids = pd.read_parquet(PATH / MARKET / 'rt_bids_2018-2019.parquet')
-    da_bids = pd.read_parquet(PATH / MARKET / 'da_bids_2018-2019.parquet')
-    da_must_take = da_bids['Must Take Energy'].groupby('DateTime').sum()
-    gas_prices = pd.read_parquet(PATH / 'gas_2018-2019.parquet')
-    load_fcst_zones = pd.read_parquet(PATH / MARKET / 'load_forecast_2018-2019.parquet')
-    load_fcst = load_fcst_zones.sum(axis=1).rename('load_forecast')
-    temperature = pd.read_parquet(PATH / MARKET / 'temperature_2018-2019.parquet')['AverageTemperature']
-
-
-    outcome = make_outcome(rt_bids) # substitute with da_bids if you want to compute day-ahead
-    print(f'Outcome variables computed.')
-
-    if MARKET == 'ISO-NE':
-        wind_fcst = pd.read_parquet(PATH / MARKET / 'wind_forecast_2018-2019.parquet')['Wind'] # missing from nyiso
-        reserves = pd.read_parquet(PATH / MARKET / 'reserves_2018-2019.parquet') # missing from nyiso
-        reserves = reserves.sum(axis=1).rename('reserves')
-        net_imports = pd.read_parquet(PATH / MARKET / 'interchange_2018-2019.parquet') # missing from nyiso
-        net_imports = net_imports.sum(axis=1).rename('net_imports')
-        treat = make_pivotality_treatment(rt_bids, load_fcst, reserves)
-        print(f'Treatment variables computed.')
-    
-    elif MARKET == 'NYISO':
-        wind_fcst, net_imports = 0, 0
-        da_congestion = pd.read_parquet(PATH / MARKET / 'da_shadow_prices_2018-2019.parquet')
-        rt_congestion = pd.read_parquet(PATH / MARKET / 'rt_shadow_prices_2018-2019.parquet')
-        treat = make_congestion_treatment(rt_congestion, load_fcst_zones)
-        outcome, treat = outcome.align(treat, axis=0, join='left')
-        print(f'Treatment variables computed.')
-    
+def join_stages(outcome:pd.DataFrame, treat:pd.DataFrame, covariates:pd.DataFrame) -> pd.DataFrame:
+    """
+    Joins the outcome, treatment and covariates on the bid index (hourly treatments are broadcast to the
+    bids of their hour) and keeps the complete rows, sorted by index and with the dtypes of the stages.
+    """
+    dtypes = pd.concat([outcome.dtypes, treat.dtypes, covariates.dtypes])
+    if treat.index.names == ['DateTime']:
+        _, treat = outcome.align(treat, axis=0, join='left')
 
-    covariates = make_covariates(rt_bids, load_fcst, 
-                                 gas_prices, 
-                                 wind_fcst=wind_fcst, 
-                                 da_must_take=da_must_take, 
-                                 net_imports=net_imports, 
-                                 temperature=temperature)
-    print(f'Covariates computed.')
-    
     dataset = pd.concat([outcome, treat, covariates], axis=1)
-    dataset = dataset.dropna(how='any', axis=0)
-    dataset.to_parquet(f'{datetime.now().strftime("%Y-%m-%d")}_{MARKET.lower()}_dataset.parquet')
+    dataset = dataset.dropna(how='any', axis=0).sort_index()
 
-    
+    return dataset.astype(dtypes)
+
+
+
+def read_hourly_inputs(path:Path, market:str) -> dict:
+    """Reads the hourly (and daily) series of a market, small enough to be kept in memory for the whole period."""
+
+    inputs = {}
+    inputs['gas_prices'] = read_source(path / 'gas_2018-2019.parquet')
+    inputs['load_fcst_zones'] = read_source(path / market / 'load_forecast_2018-2019.parquet')
+    inputs['load_fcst'] = inputs['load_fcst_zones'].sum(axis=1).rename('load_forecast')
+    inputs['temperature'] = read_source(path / market / 'temperature_2018-2019.parquet')['AverageTemperature']
+
+    if market == 'ISO-NE':
+        inputs['wind_fcst'] = read_source(path / market / 'wind_forecast_2018-2019.parquet')['Wind'] # missing from nyiso
+        reserves = read_source(path / market / 'reserves_2018-2019.parquet') # missing from nyiso
+        inputs['reserves'] = reserves.sum(axis=1).rename('reserves')
+        net_imports = read_source(path / market / 'interchange_2018-2019.parquet') # missing from nyiso
+        inputs['net_imports'] = net_imports.sum(axis=1).rename('net_imports')
+
+    elif market == 'NYISO':
+        inputs['wind_fcst'], inputs['net_imports'] = 0, 0
+        inputs['rt_congestion'] = read_source(path / market / 'rt_shadow_prices_2018-2019.parquet')
+
+    return inputs
+
+
+
+def build_dataset(path:Path, market:str, cache_dir:Path=None, instr:Instrumentation=None) -> pd.DataFrame:
+    """
+    Builds the dataset of a market in one pass over the full bid tables. Stages are memoized in cache_dir
+    and recorded in instr (load, ref_levels, rsi or congestion, covariates, join).
+    """
+
+    instr = instr or Instrumentation()
+    with instr.stage('load'):
+        hourly = read_hourly_inputs(path, market)
+        rt_bids = read_source(path / market / 'rt_bids_2018-2019.parquet')
+        da_bids = read_source(path / market / 'da_bids_2018-2019.parquet', columns=['Must Take Energy'])
+        da_must_take = da_bids['Must Take Energy'].groupby('DateTime').sum()
+        rt_book = BidBook.from_bids(rt_bids) # built once, shared by the segment consumers
+
+    # each stage is reloaded from cache_dir if its data and parameters did not change (cache_dir=None to disable)
+    with instr.stage('ref_levels'):
+        outcome = cached_stage(make_outcome, rt_book, days=90, min_bid=0, max_bid=800, cache_dir=cache_dir) # substitute with da_bids if you want to compute day-ahead
+
+    if market == 'ISO-NE':
+        with instr.stage('rsi'):
+            treat = cached_stage(make_pivotality_treatment, rt_bids, hourly['load_fcst'], hourly['reserves'], cache_dir=cache_dir)
+    elif market == 'NYISO':
+        with instr.stage('congestion'):
+            treat = cached_stage(make_congestion_treatment, hourly['rt_congestion'], hourly['load_fcst_zones'], cutoff=0.04, cache_dir=cache_dir)
+
+    with instr.stage('covariates'):
+        covariates = cached_stage(make_covariates, rt_bids, hourly['load_fcst'], 
+                                  hourly['gas_prices'], 
+                                  wind_fcst=hourly['wind_fcst'], 
+                                  da_must_take=da_must_take, 
+                                  net_imports=hourly['net_imports'], 
+                                  temperature=hourly['temperature'],
+                                  cache_dir=cache_dir)
+
+    with instr.stage('join'):
+        dataset = join_stages(outcome, treat, covariates)
+    instr.count('rows', len(dataset))
+
+    return dataset
+
+
+
+def build_dataset_chunked(path:Path, 
+                          market:str, 
+                          output:Path, 
+                          freq:str='MS', 
+                          start:datetime=None, 
+                          end:datetime=None,
+                          instr:Instrumentation=None,
+                          ) -> Path:
+    """
+    Builds the same dataset as build_dataset, one window of freq (day-aligned, e.g. 'MS' for months) at a time,
+    and appends the rows of each window to output as parquet row groups. Only the bids of the window are read,
+    the reference levels are continued from the last 90 * 24 + 24 average bids of each asset (see append_ref_level),
+    so peak memory is bounded by the window size. Congestion treatments (with their lags) are computed once on the hourly series.
+    The stages of all the windows are recorded in instr. Returns the output path.
+    """
+
+    instr = instr or Instrumentation()
+    with instr.stage('load'):
+        hourly = read_hourly_inputs(path, market)
+    rt_path, da_path = path / market / 'rt_bids_2018-2019.parquet', path / market / 'da_bids_2018-2019.parquet'
+    first, last = source_range(rt_path)
+    start = pd.Timestamp(start or first).normalize()
+    end = pd.Timestamp(end or last).normalize() + pd.Timedelta(days=1)
+    bounds = pd.date_range(start, end, freq=freq).union([start, end])
+
+    if market == 'NYISO':
+        with instr.stage('congestion'):
+            treat = make_congestion_treatment(hourly['rt_congestion'], hourly['load_fcst_zones'], cutoff=0.04)
+
+    state, writer = None, None
+    try:
+        for t0, t1 in zip(bounds[:-1], bounds[1:]):
+            t1 = t1 - pd.Timedelta(days=1) # read_source includes the end day
+            with instr.stage('load'):
+                rt_bids = read_source(rt_path, start=t0, end=t1)
+                if not rt_bids.empty:
+                    da_bids = read_source(da_path, start=t0, end=t1, columns=['Must Take Energy'])
+                    da_must_take = da_bids['Must Take Energy'].groupby('DateTime').sum()
+            if rt_bids.empty:
+                instr.skip('no bids')
+                continue
+
+            with instr.stage('ref_levels'):
+                outcome, state = make_outcome_chunk(BidBook.from_bids(rt_bids), state, days=90, min_bid=0, max_bid=800)
+            if market == 'ISO-NE':
+                with instr.stage('rsi'):
+                    treat = make_pivotality_treatment(rt_bids, hourly['load_fcst'], hourly['reserves'])
+            with instr.stage('covariates'):
+                covariates = make_covariates(rt_bids, hourly['load_fcst'], 
+                                             hourly['gas_prices'], 
+                                             wind_fcst=hourly['wind_fcst'], 
+                                             da_must_take=da_must_take, 
+                                             net_imports=hourly['net_imports'], 
+                                             temperature=hourly['temperature'])
+
+            with instr.stage('join'):
+                table = pa.Table.from_pandas(join_stages(outcome, treat, covariates))
+            with instr.stage('write'):
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            instr.count('windows')
+            instr.count('rows', table.num_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return Path(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the regression dataset of a market.")
+    parser.add_argument("--path", type=Path, default=Path('data'), help="data folder")
+    parser.add_argument("--market", choices=['ISO-NE', 'NYISO'], default='ISO-NE')
+    parser.add_argument("--chunk-freq", default=None, help="process the bids by windows of this frequency (e.g. MS for months) to bound memory")
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--report", type=Path, default=None, help="JSON report of the stage timings (default: next to the output)")
+    parser.add_argument("--profile", default=None, help="run this stage (e.g. ref_levels) under cProfile")
+    args = parser.parse_args()
+
+    output = args.output or Path(f'{datetime.now().strftime("%Y-%m-%d")}_{args.market.lower()}_dataset.parquet')
+    instr = Instrumentation(profile=args.profile, profile_path=output.with_suffix(f'.{args.profile}.prof'))
+    if args.chunk_freq is None:
+        CACHE_DIR = args.path / '.stage_cache' # inspect or clear with python -m amp_tests.stage_cache {list,clear} --dir <path>/.stage_cache
+        dataset = build_dataset(args.path, args.market, cache_dir=CACHE_DIR, instr=instr)
+        with instr.stage('write'):
+            dataset.to_parquet(output)
+    else:
+        build_dataset_chunked(args.path, args.market, output, freq=args.chunk_freq, instr=instr)
+
+    report = instr.save(args.report or output.with_suffix('.report.json'))
+    print(instr.summary())
+    print(f'Report saved to {report}.')
@@ -0,0 +1,435 @@
+import pandas as pd
+import numpy as np
+from amp_tests.utils import BidBook, as_bid_book, concat_ranges, SEGMENTS
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, Executor
+from multiprocessing import shared_memory
+from dataclasses import dataclass
+
+
+def offer_arrays(
+    bids: pd.DataFrame|BidBook,
+    hours: pd.DatetimeIndex,
+    p_floor: float = -151,
+    p_ceil: float = 1001,
+    must_run: bool = True,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Stacks the incremental bids of every hour into padded arrays of shape (hours, offers).
+    Offers are kept with the same rules as get_incremental_bids: unavailable units are dropped
+    (and must run units too if must_run is False), and only prices within (p_floor, p_ceil) are kept.
+    Padding has price +inf and 0 MW, so it always sorts at the end of the stack.
+    Returns (prices, mws).
+    """
+
+    book = as_bid_book(bids)
+    rows = book.available(must_run)
+    hours = pd.DatetimeIndex(hours)
+
+    # hour code of every bid row, rows outside of hours are dropped
+    codes = hours.get_indexer(book.hour_ix.hours)[book.hour_codes[rows]]
+    codes = np.repeat(codes, book.price.shape[1])
+    price = book.price[rows].astype(float).ravel()
+    mw = np.nan_to_num(book.mw[rows].astype(float).ravel(), nan=0)
+
+    valid = (codes >= 0) & (price > p_floor) & (price < p_ceil)
+    codes, price, mw = codes[valid], price[valid], mw[valid]
+
+    counts = np.bincount(codes, minlength=len(hours))
+    width = counts.max() if len(counts) else 0
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    pos = np.arange(len(codes)) - starts[codes]
+
+    prices = np.full((len(hours), width), np.inf)
+    mws = np.zeros((len(hours), width))
+    prices[codes, pos] = price[order]
+    mws[codes, pos] = mw[order]
+
+    return prices, mws
+
+
+def clear_offers(prices: np.ndarray, mws: np.ndarray, demand: np.ndarray) -> np.ndarray:
+    """
+    Computes the clearing price of every hour at once from padded (hours, offers) arrays.
+    Offers are sorted by price along the offer axis and the MW are cumulatively summed, then
+    the marginal offer of each hour is found with a row-wise searchsorted (number of offers whose
+    cumulative MW is below demand). Mirrors moc_equilibrium: if demand cannot be met, the cheapest
+    offer sets the price. Hours without offers get NaN.
+    """
+
+    order = np.argsort(prices, axis=1, kind="stable")
+    prices = np.take_along_axis(prices, order, axis=1)
+    cum_mw = np.cumsum(np.take_along_axis(mws, order, axis=1), axis=1)
+
+    demand = np.asarray(demand, dtype=float)
+    n_offers = np.isfinite(prices).sum(axis=1)
+    pos = (cum_mw < demand[:, None]).sum(axis=1)
+    pos[pos >= n_offers] = 0 # demand not met (or NaN): cheapest offer, as idxmax of all False
+
+    lmp = np.full(len(prices), np.nan)
+    has_offers = n_offers > 0
+    lmp[has_offers] = prices[has_offers, pos[has_offers]]
+
+    return lmp
+
+
+def _clear_block(names: tuple[str, str, str], shape: tuple[int, int], start: int, stop: int) -> np.ndarray:
+    """Worker task: clears the hours start:stop of the (prices, mws, demand) arrays in shared memory."""
+
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    try:
+        prices = np.ndarray(shape, dtype=float, buffer=blocks[0].buf)[start:stop]
+        mws = np.ndarray(shape, dtype=float, buffer=blocks[1].buf)[start:stop]
+        demand = np.ndarray(shape[:1], dtype=float, buffer=blocks[2].buf)[start:stop]
+        lmp = clear_offers(prices, mws, demand)
+        del prices, mws, demand # release the views before closing the buffers
+    finally:
+        for shm in blocks:
+            shm.close()
+
+    return lmp
+
+
+def clear_offers_shared(
+    prices: np.ndarray,
+    mws: np.ndarray,
+    demand: np.ndarray,
+    executor: Executor,
+    n_blocks: int,
+) -> np.ndarray:
+    """
+    Same as clear_offers, with the hours split into n_blocks cleared by the worker processes of executor.
+    The arrays are copied once into shared memory, workers only receive the block names and row offsets.
+    Blocks are gathered in order, so the result is identical to the serial path.
+    """
+
+    arrays = [np.asarray(prices, dtype=float), np.asarray(mws, dtype=float), np.asarray(demand, dtype=float)]
+    blocks = [shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1)) for a in arrays]
+    try:
+        for a, shm in zip(arrays, blocks):
+            np.ndarray(a.shape, dtype=float, buffer=shm.buf)[:] = a
+
+        names = tuple(shm.name for shm in blocks)
+        bounds = np.linspace(0, len(prices), n_blocks + 1).astype(int)
+        futures = [
+            executor.submit(_clear_block, names, prices.shape, start, stop)
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+        ]
+        lmp = [f.result() for f in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return np.concatenate(lmp) if lmp else np.array([], dtype=float)
+
+
+def hour_chunks(
+    book: BidBook, hours: pd.DatetimeIndex, chunk_hours: int
+) -> Iterator[tuple[np.ndarray, pd.DatetimeIndex, BidBook]]:
+    """
+    Splits hours (in any order, possibly without bids) into chunks of chunk_hours sorted hours and yields,
+    for each chunk, the positions of its hours in hours, the chunk and the sub-book of its rows (a contiguous
+    row range, the book being sorted by hour).
+    """
+
+    hours = pd.DatetimeIndex(hours)
+    order = np.argsort(hours.values, kind="stable")
+    for i in range(0, len(hours), chunk_hours):
+        pos = order[i : i + chunk_hours]
+        chunk = hours[pos]
+        start = book.hour_ix.offsets[book.hour_ix.hours.searchsorted(chunk[0], side="left")]
+        stop = book.hour_ix.offsets[book.hour_ix.hours.searchsorted(chunk[-1], side="right")]
+        yield pos, chunk, book.take(slice(start, stop))
+
+
+def clear_market(
+    bids: pd.DataFrame|BidBook,
+    demand: pd.Series,
+    p_floor: float = -151,
+    p_ceil: float = 1001,
+    chunk_hours: int = 744,
+    workers: int = 1,
+) -> pd.Series:
+    """
+    Batched counterpart of moc_equilibrium: clears all the hours in demand.index (in any order) with the
+    bids of the same hour. Hours are processed in chunks of chunk_hours to bound the size of the padded arrays.
+    With workers > 1, each chunk is sorted and cleared by a pool of worker processes (see clear_offers_shared).
+    Returns pd.Series of prices indexed by DateTime.
+    """
+
+    hours = pd.DatetimeIndex(demand.index)
+    book = as_bid_book(bids)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    lmp = np.full(len(hours), np.nan)
+
+    try:
+        for pos, chunk, chunk_book in hour_chunks(book, hours, chunk_hours):
+            prices, mws = offer_arrays(chunk_book, chunk, p_floor=p_floor, p_ceil=p_ceil)
+            demand_chunk = demand.to_numpy()[pos]
+            if executor is None:
+                lmp[pos] = clear_offers(prices, mws, demand_chunk)
+            else:
+                lmp[pos] = clear_offers_shared(prices, mws, demand_chunk, executor, n_blocks=workers)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    res = pd.Series(lmp, index=hours, name="price")
+    res.index.name = "DateTime"
+
+    return res
+
+
+@dataclass
+class SupplyStack:
+    """
+    Merit order of every hour, sorted once: the offers of hour i are prices[offsets[i]:offsets[i + 1]]
+    in increasing price order, with their cumulative MW in cum_mw. Any number of demands per hour is
+    then cleared with a binary search in the cumulative MW, with the same rules as clear_offers
+    (offer MW are non-negative, so cum_mw is non-decreasing within each hour).
+    """
+
+    hours: pd.DatetimeIndex
+    offsets: np.ndarray
+    prices: np.ndarray
+    cum_mw: np.ndarray
+
+    @classmethod
+    def from_bids(
+        cls,
+        bids: pd.DataFrame|BidBook,
+        hours: pd.DatetimeIndex = None,
+        p_floor: float = -151,
+        p_ceil: float = 1001,
+        chunk_hours: int = 744,
+    ) -> "SupplyStack":
+        """
+        Builds the supply stacks of hours (default: all the hours of the bids, otherwise in the given order),
+        chunk_hours at a time.
+        """
+
+        book = as_bid_book(bids)
+        hours = book.hour_ix.hours if hours is None else pd.DatetimeIndex(hours)
+        positions, counts, prices, cum_mw = [], [], [], []
+
+        for pos, chunk, chunk_book in hour_chunks(book, hours, chunk_hours):
+            p, mw = offer_arrays(chunk_book, chunk, p_floor=p_floor, p_ceil=p_ceil)
+            order = np.argsort(p, axis=1, kind="stable")
+            p = np.take_along_axis(p, order, axis=1)
+            cum = np.cumsum(np.take_along_axis(mw, order, axis=1), axis=1)
+            n_offers = np.isfinite(p).sum(axis=1)
+            keep = np.arange(p.shape[1]) < n_offers[:, None] # drop the padding
+            positions.append(pos)
+            counts.append(n_offers)
+            prices.append(p[keep])
+            cum_mw.append(cum[keep])
+
+        positions = np.concatenate(positions) if positions else np.array([], dtype=int)
+        counts = np.concatenate(counts) if counts else np.array([], dtype=int)
+        prices = np.concatenate(prices) if prices else np.array([], dtype=float)
+        cum_mw = np.concatenate(cum_mw) if cum_mw else np.array([], dtype=float)
+
+        # stacks are built in sorted order: put them back in the order of hours
+        if (np.diff(positions) < 0).any():
+            back = np.argsort(positions)
+            rows = concat_ranges((np.cumsum(counts) - counts)[back], counts[back])
+            counts, prices, cum_mw = counts[back], prices[rows], cum_mw[rows]
+
+        return cls(
+            hours=pd.DatetimeIndex(hours, name="DateTime"),
+            offsets=np.concatenate([[0], np.cumsum(counts)]),
+            prices=prices,
+            cum_mw=cum_mw,
+        )
+
+    def __len__(self) -> int:
+        return len(self.hours)
+
+    def clear(self, demand: np.ndarray) -> np.ndarray:
+        """
+        Clearing prices for demand of shape (hours,) or (hours, n): the price of the first offer whose
+        cumulative MW reaches the demand. As in moc_equilibrium, if demand cannot be met (or is NaN), the
+        cheapest offer sets the price. Hours without offers get NaN. Returns an array of the shape of demand.
+        """
+
+        demand = np.asarray(demand, dtype=float)
+        flat = demand.reshape(len(self), -1)
+        lmp = np.full(flat.shape, np.nan)
+
+        for i, (start, stop) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            if stop > start:
+                pos = np.searchsorted(self.cum_mw[start:stop], flat[i], side="left")
+                pos[pos >= stop - start] = 0 # demand not met (or NaN): cheapest offer
+                lmp[i] = self.prices[start + pos]
+
+        return lmp.reshape(demand.shape)
+
+
+    def reclear(
+        self, demand: np.ndarray, base: np.ndarray, hour: np.ndarray, price: np.ndarray, mw: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Clearing prices after changing a few offers of the stacks, without rebuilding them. Changes are
+        signed offers: (hour position, price, -MW) removes an offer and (hour position, price, +MW) adds one
+        (see offer_changes). base are the prices of the unchanged stacks for demand (from clear). Hours
+        whose changes are all above their base price keep it. In the others, the supply at each price is
+        the cumulative MW of the stack plus the changes at or below that price: the new price is found with
+        one binary search per price interval between changes, so the cost grows with the number of changes
+        rather than with the size of the stack.
+        Returns (lmp, full): full marks the hours that need a full re-clear (no offers, demand not met or NaN).
+        """
+
+        demand = np.asarray(demand, dtype=float)
+        lmp = np.asarray(base, dtype=float).copy()
+        full = np.zeros(len(self), dtype=bool)
+        if not len(hour):
+            return lmp, full
+
+        # demand is met by the unchanged stack (otherwise the cheapest offer sets the price)
+        sizes = np.diff(self.offsets)
+        total = np.where(sizes > 0, self.cum_mw[np.maximum(self.offsets[1:] - 1, 0)] if len(self.cum_mw) else 0, 0)
+        met = (total >= demand) & (demand > 0)
+
+        # hours with a change at or below the base price (or where the base price does not come from the stack)
+        touched = np.unique(hour[~(price > lmp[hour]) | ~met[hour]]) # NaN base prices are touched too
+        order = np.argsort(hour, kind="stable")
+        hour, price, mw = hour[order], price[order], mw[order]
+        bounds = np.searchsorted(hour, np.stack([touched, touched + 1]))
+
+        for i, lo, hi in zip(touched, *bounds):
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            if not met[i]:
+                full[i] = True
+                continue
+            new = _reclear_stack(self.prices[start:stop], self.cum_mw[start:stop], demand[i], price[lo:hi], mw[lo:hi])
+            if np.isfinite(new):
+                lmp[i] = new
+            else:
+                full[i] = True
+
+        return lmp, full
+
+
+def _reclear_stack(
+    prices: np.ndarray, cum_mw: np.ndarray, demand: float, change_price: np.ndarray, change_mw: np.ndarray
+) -> float:
+    """
+    Clearing price of one sorted stack (prices, cum_mw) with signed offer changes, or inf if demand is not met.
+    The supply at a price is cum_mw plus the changes at or below it, so between two changed prices it is
+    cum_mw shifted by a constant: the first offer reaching demand is found with one binary search per interval,
+    all done in a single searchsorted. Added offers are candidates too.
+    """
+
+    order = np.argsort(change_price, kind="stable")
+    levels, first = np.unique(change_price[order], return_index=True) # changed prices
+    delta = np.cumsum(np.add.reduceat(change_mw[order], first)) # changes at or below each level
+
+    # cum_mw is non-decreasing over the whole stack, so the first offer of interval [lo, hi) reaching
+    # demand - d is the first offer of the stack reaching it, moved to lo
+    cuts = np.concatenate([[0], np.searchsorted(prices, levels, side="left"), [len(prices)]])
+    j = np.maximum(cuts[:-1], np.searchsorted(cum_mw, demand - np.concatenate([[0], delta]), side="left"))
+    found = np.flatnonzero(j < cuts[1:])
+    best = prices[j[found[0]]] if len(found) else np.inf # intervals are in increasing price order
+
+    added = change_price[change_mw > 0]
+    below = np.searchsorted(prices, added, side="right") - 1
+    supply = np.where(below >= 0, cum_mw[np.maximum(below, 0)], 0) + delta[np.searchsorted(levels, added)]
+    reached = added[supply >= demand]
+
+    return min(best, reached.min()) if len(reached) else best
+
+
+def offer_changes(
+    bids: pd.DataFrame|BidBook,
+    mitigated: pd.DataFrame,
+    hours: pd.DatetimeIndex,
+    p_floor: float = -151,
+    p_ceil: float = 1001,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Offers that differ between bids and their mitigated copy (same rows, only segment prices changed, as
+    returned by mitigate_period), as signed offers for SupplyStack.reclear: the old offer is removed (-MW)
+    and the new one added (+MW), each only if its price is within (p_floor, p_ceil) as in offer_arrays.
+    Returns (hour position in hours, price, MW).
+    """
+
+    book = as_bid_book(bids)
+    if not mitigated.index.equals(book.index):
+        mitigated = mitigated.reindex(book.index) # rows dropped by mitigate_period have no offers
+    new_price = mitigated[[f"Segment {s} Price" for s in SEGMENTS]].to_numpy(dtype=float)
+
+    rows, seg = np.nonzero(
+        (book.price != new_price) & ~(np.isnan(book.price) & np.isnan(new_price)) & book.available(True)[:, None]
+    )
+    codes = pd.DatetimeIndex(hours).get_indexer(book.hour_ix.hours)[book.hour_codes[rows]]
+    old_p, new_p = book.price[rows, seg].astype(float), new_price[rows, seg]
+    mw = np.nan_to_num(book.mw[rows, seg].astype(float), nan=0)
+
+    removed = (codes >= 0) & (old_p > p_floor) & (old_p < p_ceil) & (mw != 0)
+    added = (codes >= 0) & (new_p > p_floor) & (new_p < p_ceil) & (mw != 0)
+
+    return (
+        np.concatenate([codes[removed], codes[added]]),
+        np.concatenate([old_p[removed], new_p[added]]),
+        np.concatenate([-mw[removed], mw[added]]),
+    )
+
+
+def reclear_market(
+    stack: SupplyStack,
+    base: np.ndarray,
+    bids: pd.DataFrame|BidBook,
+    mitigated: pd.DataFrame,
+    demand: pd.Series,
+    p_floor: float = -151,
+    p_ceil: float = 1001,
+    workers: int = 1,
+    max_changes: float = 0.25,
+) -> pd.Series:
+    """
+    Clears the hours of stack with the mitigated bids, updating the prices base of the unmitigated stack
+    (stack.clear(demand)) with the offers changed by mitigation. Hours that need it (see SupplyStack.reclear)
+    are cleared again from the mitigated bids with clear_market, as all the hours if the changes are more than
+    max_changes of the offers of stack. bids (the unmitigated bids of stack, ideally as a BidBook built once)
+    and mitigated must have the same rows. Returns pd.Series of prices indexed by DateTime, as
+    clear_market(mitigated, demand).
+    """
+
+    demand = demand.reindex(stack.hours).astype(float)
+    changes = offer_changes(bids, mitigated, stack.hours, p_floor, p_ceil)
+    if len(changes[0]) > max_changes * len(stack.prices):
+        return clear_market(mitigated, demand, p_floor=p_floor, p_ceil=p_ceil, workers=workers)
+
+    lmp, full = stack.reclear(demand.to_numpy(), base, *changes)
+    if full.any():
+        lmp[full] = clear_market(mitigated, demand[full], p_floor=p_floor, p_ceil=p_ceil, workers=workers).to_numpy()
+
+    res = pd.Series(lmp, index=stack.hours, name="price")
+    res.index.name = "DateTime"
+
+    return res
+
+
+def monte_carlo_prices(
+    stack: SupplyStack,
+    load_fcst: pd.Series,
+    perturbations: np.ndarray,
+    relative: bool = True,
+) -> pd.DataFrame:
+    """
+    Clearing prices under demand perturbations around the load forecast, e.g. for forecast errors of 2%:
+    monte_carlo_prices(stack, load_fcst, np.random.default_rng(0).normal(0, 0.02, (len(stack), 1000))).
+    perturbations has shape (n_draws,) (same draws for every hour) or (hours, n_draws); demand is
+    load_fcst * (1 + perturbation) if relative, else load_fcst + perturbation (in MW).
+    Returns pd.DataFrame indexed by the hours of stack with one column of prices per draw.
+    """
+
+    load = load_fcst.reindex(stack.hours).to_numpy(dtype=float)[:, None]
+    perturbations = np.asarray(perturbations, dtype=float)
+    perturbations = np.broadcast_to(perturbations, (len(stack), perturbations.shape[-1]))
+    demand = load * (1 + perturbations) if relative else load + perturbations
+
+    return pd.DataFrame(stack.clear(demand), index=stack.hours)
@@ -0,0 +1,147 @@
+"""
+
+Runs a scenario grid over a long period as independent jobs: the date range is split into shards (e.g. months)
+and the shards are simulated in a pool of processes. Each job loads only the data of its shard, plus the
+look-back of the reference levels, and simulates all the scenarios of the shard with one load (run_scenarios).
+The look-back covers the full window of bids of every asset (see load_inputs), so the merged prices equal
+those of an unsharded run_scenarios over the whole range (checked by benchmarks/check_equivalence.py).
+The prices of each shard are saved in OUT/shards, so a new run with the same OUT only runs the shards that
+failed or miss a scenario, then merges all the shards into OUT/prices.parquet (DateTime x scenario).
+
+Usage (from the repository root):
+    python simulation/run_jobs.py --input data/isone_rawdata --start 2018-04-01 --end 2020-01-01 --freq MS \
+        --structural-threshold 1 inf --rel-conduct-threshold 2 3 --abs-conduct-threshold 50 100 --workers 4
+
+"""
+
+import os
+import sys
+import argparse
+import traceback
+import pandas as pd
+import pyarrow.parquet as pq
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(str(Path(__file__).parent.parent)) # add the path to the parent directory to sys.path
+from simulation.run_simulation import FOLDER, run_scenarios, scenario_grid, scenario_name
+from amp_tests.instrumentation import Instrumentation
+
+
+
+def shard_ranges(start: str, end: str, freq: str = "MS") -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """Splits [start, end) into consecutive shards [start, end) at the boundaries of freq (e.g. MS for months)."""
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    bounds = pd.date_range(start, end, freq=freq).union([start, end])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_path(out: Path, start: pd.Timestamp, end: pd.Timestamp) -> Path:
+    return Path(out) / "shards" / f"{start:%Y%m%d%H}-{end:%Y%m%d%H}.parquet"
+
+
+def missing_scenarios(path: Path, scenarios: dict[str, dict]) -> dict[str, dict]:
+    """Scenarios that are not yet in the saved prices of a shard (all if the shard was not saved)."""
+    if not path.exists():
+        return scenarios
+    done = set(pq.read_schema(path).names)
+    return {name: params for name, params in scenarios.items() if name not in done}
+
+
+def run_shard(
+    input_folder: str, start: pd.Timestamp, end: pd.Timestamp, scenarios: dict[str, dict], out: Path
+) -> Path:
+    """
+    Worker task: simulates the scenarios in [start, end) and adds their prices to the saved prices of the
+    shard (written to a temporary file first, so a failed job leaves the previous file intact).
+    Also saves the stage report of the job next to it.
+    """
+
+    instr = Instrumentation()
+    runs = run_scenarios(input_folder, scenarios, start_str=start, end_str=end, verbose=False, instr=instr)
+
+    path = shard_path(out, start, end)
+    if path.exists():
+        runs = pd.read_parquet(path).join(runs, how="outer")
+    tmp = path.with_suffix(".tmp")
+    runs.to_parquet(tmp)
+    os.replace(tmp, path)
+    instr.save(path.with_suffix(".report.json"))
+
+    return path
+
+
+def run_jobs(
+    input_folder: str,
+    scenarios: list[dict]|dict[str, dict],
+    start: str,
+    end: str,
+    out: Path,
+    freq: str = "MS",
+    workers: int = 4,
+) -> pd.DataFrame|None:
+    """
+    Simulates the scenarios over [start, end) by shards of freq in a pool of workers processes and merges
+    the shards into out/prices.parquet. Shards already saved with all the scenarios are not run again.
+    Returns the merged prices, or None if some shards failed (run again with the same out to retry them).
+    """
+
+    if not isinstance(scenarios, dict):
+        scenarios = {scenario_name(s): s for s in scenarios}
+    out = Path(out)
+    (out / "shards").mkdir(parents=True, exist_ok=True)
+
+    shards = shard_ranges(start, end, freq)
+    jobs = {(s, e): missing_scenarios(shard_path(out, s, e), scenarios) for s, e in shards}
+    jobs = {shard: todo for shard, todo in jobs.items() if todo}
+    print(f"{len(shards) - len(jobs)} of {len(shards)} shards complete, {len(jobs)} to run.")
+
+    failed = []
+    if jobs:
+        with ProcessPoolExecutor(max(1, min(workers, len(jobs)))) as executor:
+            futures = {
+                shard: executor.submit(run_shard, input_folder, *shard, todo, out) for shard, todo in jobs.items()
+            }
+            for (s, e), future in futures.items():
+                try:
+                    future.result()
+                    print(f"{s:%Y-%m-%d %H:%M} to {e:%Y-%m-%d %H:%M} done.")
+                except Exception:
+                    failed.append((s, e))
+                    print(f"{s:%Y-%m-%d %H:%M} to {e:%Y-%m-%d %H:%M} failed:\n{traceback.format_exc()}")
+
+    if failed:
+        print(f"{len(failed)} shards failed, run again with the same output folder to retry them.")
+        return None
+
+    prices = pd.concat([pd.read_parquet(shard_path(out, s, e))[list(scenarios)] for s, e in shards]).sort_index()
+    prices.to_parquet(out / "prices.parquet")
+    print(f"Prices of {len(scenarios)} scenarios saved to {out / 'prices.parquet'}.")
+
+    return prices
+
+
+
+if __name__ == "__main__":
+    flag = lambda s: s.lower() in ("1", "true", "yes")
+    number = lambda s: int(s) if s.lstrip("-").isdigit() else float(s) # as the defaults, so names match between runs
+    parser = argparse.ArgumentParser(description="Simulates a scenario grid by shards of the date range in a pool of processes.")
+    parser.add_argument("--input", default=FOLDER, help="input folder of the simulation data")
+    parser.add_argument("--start", default="2019-01-01", help="first day of the simulation")
+    parser.add_argument("--end", default="2020-01-01", help="end of the simulation (not inclusive)")
+    parser.add_argument("--freq", default="MS", help="shard frequency (e.g. MS for months, 7D for weeks)")
+    parser.add_argument("--out", type=Path, default=Path("output/jobs"), help="output folder (shards and merged prices)")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--mitigate-conduct", nargs="+", type=flag, default=[True])
+    parser.add_argument("--structural-threshold", nargs="+", type=number, default=[1])
+    parser.add_argument("--rel-conduct-threshold", nargs="+", type=number, default=[3])
+    parser.add_argument("--abs-conduct-threshold", nargs="+", type=number, default=[100])
+    args = parser.parse_args()
+
+    scenarios = scenario_grid(
+        mitigate_conduct=args.mitigate_conduct,
+        structural_threshold=args.structural_threshold,
+        rel_conduct_threshold=args.rel_conduct_threshold,
+        abs_conduct_threshold=args.abs_conduct_threshold,
+    )
+    prices = run_jobs(args.input, scenarios, args.start, args.end, args.out, freq=args.freq, workers=args.workers)
+    sys.exit(0 if prices is not None else 1)
@@ -1,46 +1,37 @@
+import os
 import sys
+import json
 from pathlib import Path
 # Add the parent directory to sys.path to import modules from there
 sys.path.append(
     str(Path(__file__).parent.parent)
 )  # add the path to the parent directory to sys.path
 from amp_tests.structural_test import residual_supplier_index, congested_area_test
-from amp_tests.conduct_test import ref_level, mitigate_bids
+from amp_tests.conduct_test import ref_level, mitigate_period
+from amp_tests.sources import read_source
 from datetime import datetime as dt, timedelta as td
-from amp_tests.utils import get_incremental_bids
+from amp_tests.utils import get_incremental_bids, sort_by_hour, HourIndex, BidBook
+from simulation.clearing import clear_market, reclear_market, SupplyStack
+from amp_tests.instrumentation import Instrumentation
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
-from multiprocessing.pool import ThreadPool
+from dataclasses import dataclass
+from itertools import product
 
 FOLDER = "data/isone_rawdata"
-
-
-def read_source(
-    path: Path,
-    start: dt = None,
-    end: dt = None,
-    sum_ax1: bool = False,
-    multiindex: bool = False,
-) -> pd.DataFrame:
-    """Reads a .parquet source file and returns a DataFrame with the data between start and end dates."""
-    source = pd.read_parquet(path)
-
-    if sum_ax1:
-        source = source.sum(axis=1)
-
-    if not (start is None or end is None):
-        if multiindex:
-            source = source[
-                (source.index.get_level_values("DateTime").date >= start.date())
-                & (source.index.get_level_values("DateTime").date <= end.date())
-            ]
-        else:
-            source = source[
-                (source.index.date >= start.date()) & (source.index.date <= end.date())
-            ]
-
-    return source
+BID_COLUMNS = [
+    *[f"Segment {s} {v}" for s in range(1, 11) for v in ("Price", "MW")],
+    "Economic Maximum",
+    "Must Take Energy",
+    "Unit Status",
+]
+SKIP_REASONS = ("not in the load or price", "congested", "mitigated")
+SCENARIO_DEFAULTS = dict(
+    mitigate_conduct=True,
+    structural_threshold=1,
+    rel_conduct_threshold=3,
+    abs_conduct_threshold=100,
+)
 
 
 def mitigate_impact(price: pd.Series, mit_price: pd.Series, rel_impact_threshold: int = 2, abs_impact_threshold: int = 100) -> pd.Series:
@@ -73,100 +64,377 @@ def moc_equilibrium(bids:pd.DataFrame, demand:float=None) -> float:
     return lmp
 
 
-def run_simulation(
-    input_folder: str,
-    start_str: str = "2019-01-01",
-    end_str: str = "2019-12-01",
-    mitigate_conduct: bool = True,
-    structural_threshold: int = 1,  # threshold for structural test
-    rel_conduct_threshold: int = 3, # relative threshold for conduct mitigation
-    abs_conduct_threshold: int = 100, # absolute threshold for conduct mitigation
-    verbose: bool = True,
-) -> None:
+@dataclass
+class SimulationInputs:
+    """Market data and scenario-independent precomputations shared by all simulated scenarios."""
+
+    book: BidBook  # the bids, sorted by DateTime (the bid table is rebuilt for the rows to mitigate only)
+    hour_ix: HourIndex
+    ref_levels: pd.Series  # aligned to the rows of book
+    rsi: pd.Series  # sorted by DateTime
+    load_fcst: pd.Series
+    rt_prices: pd.DataFrame
+    const_hour: pd.Series
+    flag_hour: pd.Series
+
+
+@dataclass
+class BaseClearing:
+    """Unmitigated bids, supply stacks and prices of the simulated hours, shared by the scenarios of a sweep."""
+
+    book: BidBook
+    stack: SupplyStack
+    prices: np.ndarray
+
+    @classmethod
+    def from_inputs(cls, inputs: "SimulationInputs", hours: pd.DatetimeIndex) -> "BaseClearing":
+        book = inputs.book.take(inputs.hour_ix.rows(hours))
+        stack = SupplyStack.from_bids(book, hours, p_floor=-151, p_ceil=1001)
+        return cls(book=book, stack=stack, prices=stack.clear(inputs.load_fcst.reindex(hours).to_numpy(dtype=float)))
+
+
+def bids_lookback(path: Path, start: dt, end: dt, n_bids: int) -> pd.Timestamp:
+    """
+    First hour from which bids must be read so that every asset bidding between start and end has its last
+    n_bids bids before start (all its bids if it has fewer). Only the index of the bids is read.
+    """
+
+    start = pd.Timestamp(start)
+    index = read_source(path, end=end, columns=[]).index
+    times = pd.Series(index.get_level_values("DateTime"), index=index.get_level_values("Masked Asset ID"))
+    history = times[times < start]
+    history = history[history.index.isin(times[times >= start].index)].sort_values(kind="stable")
+
+    return history.groupby(level=0).tail(n_bids).min() if len(history) else start
+
+
+def load_inputs(
+    input_folder: str, start: dt = None, end: dt = None, days: int = 90, instr: Instrumentation = None
+) -> SimulationInputs:
+    """
+    Reads the market data between start and end and computes residual supplier index, reference levels and 
+    congestion test once. Bids are also read before start, back to the last days * 24 + 24 bids of each asset
+    (rolling window plus the 24-hour lag, see bids_lookback), so the reference levels equal those of a run
+    over the full history whatever start is. The residual supplier index is only computed from start.
+    Each step is recorded as a stage of instr (load, rsi, sort, ref_levels, congestion).
+    """
 
     # TODO: include reserves and interchange
+    instr = instr or Instrumentation()
     FILEPATH = Path(input_folder)
+    bids_path = FILEPATH / "rt_bids_2018-2019.parquet"
 
-    date_range = pd.date_range(
-        start=start_str, end=end_str, freq="h", inclusive="left")
+    with instr.stage("load"):
+        bids_start = bids_lookback(bids_path, start, end, days * 24 + 24) if start is not None else None
+        bids = read_source(bids_path, start=bids_start, end=end, columns=BID_COLUMNS)
+        rt_prices = read_source(FILEPATH / "rt_prices_2018-2019.parquet", start=start, end=end)
+       
+        load_fcst = read_source(FILEPATH / "load_forecast_2018-2019.parquet", start=start, end=end, sum_ax1=True)
+        reserves = read_source(FILEPATH / "reserves_2018-2019.parquet", start=start, end=end, sum_ax1=True)
+        flag_hour = read_source(
+            FILEPATH / "mitigated_hours_2018-2019.parquet", start=start, end=end, columns=["Real-Time mitigated?"]
+        )
+        flag_hour = flag_hour["Real-Time mitigated?"]
 
-    bids = read_source(
-        FILEPATH / "rt_bids_2018-2019.parquet", multiindex=True
-    )
-    rt_prices = read_source(FILEPATH / "rt_prices_2018-2019.parquet")
-   
-    load_fcst = read_source(FILEPATH / "load_forecast_2018-2019.parquet", sum_ax1=True)
-    reserves = read_source(FILEPATH / "reserves_2018-2019.parquet", sum_ax1=True)
-    flag_hour = read_source(
-        FILEPATH / "mitigated_hours_2018-2019.parquet",
-    )
-    flag_hour = flag_hour["Real-Time mitigated?"]
+    with instr.stage("rsi"):
+        in_range = bids.index.get_level_values("DateTime") >= start if start is not None else slice(None)
+        rsi = residual_supplier_index(
+            bids[in_range], load_fcst, reserves=reserves
+        )
 
-    rsi = residual_supplier_index(
-        bids, load_fcst, reserves=reserves
-    )
-    
-    pst = (rsi < structural_threshold)
-    ref_levels = ref_level(
-        bids, min_bid=0, max_bid=800, days=90
-    ).rename('ref_level')  
+    # sort once by hour, so that every hour is a contiguous row range of the book and of the reference
+    # levels (computed on the book, so they are aligned to its rows); only the book is kept
+    with instr.stage("sort"):
+        book = BidBook.from_bids(bids)
+        del bids
+        rsi = sort_by_hour(rsi)
+
+    with instr.stage("ref_levels"):
+        ref_levels = ref_level(
+            book, min_bid=0, max_bid=800, days=days
+        ).rename('ref_level')  
     
-    const_hour = congested_area_test(rt_prices)
-    print("Reference levels and pivotal supplier test computed.\n") if verbose else None
+    with instr.stage("congestion"):
+        const_hour = congested_area_test(rt_prices)
+
+    return SimulationInputs(
+        book=book,
+        hour_ix=book.hour_ix,
+        ref_levels=ref_levels,
+        rsi=rsi,
+        load_fcst=load_fcst,
+        rt_prices=rt_prices,
+        const_hour=const_hour,
+        flag_hour=flag_hour,
+    )
+
+
+def skip_reasons(inputs: SimulationInputs, date_range: pd.DatetimeIndex) -> pd.Series:
+    """
+    Reason why each hour of date_range is not simulated (the first of SKIP_REASONS that applies), missing for
+    the simulated hours: not congested, not mitigated and with load and prices.
+    """
+
+    missing = ~(date_range.isin(inputs.load_fcst.index) & date_range.isin(inputs.rt_prices.index))
+    congested = inputs.const_hour.reindex(date_range, fill_value=False).to_numpy(dtype=bool)
+    mitigated = inputs.flag_hour.reindex(date_range, fill_value=False).to_numpy(dtype=bool)
+    reasons = np.select([missing, congested, mitigated], SKIP_REASONS, default="")
+
+    return pd.Series(reasons, index=pd.DatetimeIndex(date_range, name="DateTime"), name="skipped", dtype=object).mask(reasons == "")
+
+
+def simulation_hours(
+    inputs: SimulationInputs, date_range: pd.DatetimeIndex, instr: Instrumentation = None
+) -> pd.DatetimeIndex:
+    """
+    Returns the hours of date_range that are simulated: not congested, not mitigated and with load and prices.
+    Skipped hours are counted in instr by reason.
+    """
+
+    instr = instr or Instrumentation()
+    reasons = skip_reasons(inputs, date_range)
+    for reason in SKIP_REASONS:
+        instr.skip(reason, (reasons == reason).sum())
+
+    return reasons.index[reasons.isna()]
+
+
+def simulate(
+    inputs: SimulationInputs,
+    hours: pd.DatetimeIndex,
+    mitigate_conduct: bool = True,
+    structural_threshold: int = 1,
+    rel_conduct_threshold: int = 3,
+    abs_conduct_threshold: int = 100,
+    verbose: bool = True,
+    workers: int = 1,
+    instr: Instrumentation = None,
+    base: BaseClearing = None,
+) -> pd.Series:
+    """
+    Mitigates the bids of one scenario in the given hours and clears the market. Returns the price series.
+    With workers > 1, the market is cleared in a pool of worker processes reading the bids from shared memory.
+    With the base clearing of the same hours, the unmitigated prices are reused and only the offers changed
+    by mitigation are re-cleared (see reclear_market).
+    Mitigation and clearing are recorded as stages of instr, with the number of mitigated bids.
+    """
+
+    instr = instr or Instrumentation()
+    pst = (inputs.rsi < structural_threshold)
     (
         print(
-            f"% hours with at least one pivotal supplier: {(pst.groupby("DateTime").sum() >= 1).mean():.2%}"
+            f"% hours with at least one pivotal supplier: {(pst.groupby('DateTime').sum().reindex(hours, fill_value=0) >= 1).mean():.2%}"
         )
         if verbose
         else None
     )
 
-    ix = []
-    bids_lmp = []
-    
-    for t in tqdm(date_range):
-
-        print(f"PROCESSING {t}.\n") if verbose else None
-  
-        if t not in load_fcst.index or t not in rt_prices.index:
-            print(f"Skipping {t} because it is not in the load or price.\n")
-
-        elif const_hour[t]:
-            print(f"Skipping {t} because it is congested.\n")
-                 
-        elif flag_hour[t]:
-            print(f"Skipping {t} because it is mitigated.\n")
-            
+    rows = inputs.hour_ix.rows(hours)
+    bids_lmp = base.book if base is not None else inputs.book.take(rows)
+
+    if mitigate_conduct:
+        with instr.stage("mitigation"):
+            ref_levels = inputs.ref_levels.iloc[rows]
+            bids_lmp, counts = mitigate_period(
+                bids_lmp.to_frame(), pst, ref_levels, rel_ref=rel_conduct_threshold, abs_ref=abs_conduct_threshold
+            )
+        instr.count("mitigated bids", counts.iloc[:, 1:].sum().sum())
+        print(f"Mitigated bids: {counts.iloc[:, 1:].sum().sum()}") if verbose else None
+
+    # clear all hours at once on padded (hours x offers) arrays, or update the base prices
+    with instr.stage("clearing"):
+        demand = inputs.load_fcst.reindex(hours).astype(float)
+        if base is None:
+            res = clear_market(bids_lmp, demand, p_floor=-151, p_ceil=1001, workers=workers)
+        elif not mitigate_conduct:
+            res = pd.Series(base.prices, index=base.stack.hours, name="price")
         else:
+            res = reclear_market(base.stack, base.prices, base.book, bids_lmp, demand, p_floor=-151, p_ceil=1001, workers=workers)
+
+    return res
 
-            bids_t = bids[bids.index.get_level_values("DateTime") == t]
-            
-            if mitigate_conduct:
-                ref_t = ref_levels[
-                    ref_levels.index.get_level_values("DateTime") == t
-                ]
-                pst_t = pst[pst.index.get_level_values("DateTime") == t]
-                bids_t = mitigate_bids(bids_t, pst_t, ref_t, rel_ref=rel_conduct_threshold, abs_ref=abs_conduct_threshold, verbose=False)
 
-            bids_lmp.append((bids_t, load_fcst[t]))
-            ix.append(t)
+def read_checkpoints(checkpoint_dir: Path, params: dict) -> pd.DataFrame:
+    """
+    Reads the hours completed by a checkpointed run: price and skip reason of each hour, indexed by DateTime.
+    The run must have been started with the same params (saved in params.json), otherwise raises ValueError.
+    """
 
-        print(f"PROCESSED {t}.\n") if verbose else None
+    checkpoint_dir = Path(checkpoint_dir)
+    params_path = checkpoint_dir / "params.json"
+    if params_path.exists():
+        saved = json.loads(params_path.read_text())
+        if saved != params:
+            raise ValueError(f"{checkpoint_dir} holds a run with other parameters: {saved}.")
+    else:
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        params_path.write_text(json.dumps(params, indent=2))
 
-    with ThreadPool(10) as pool:
-        prices = pool.starmap(moc_equilibrium, bids_lmp)
-    
-    # Create a DataFrame to store the results
-    res = pd.Series(index=ix, data=prices, name="price")
-    res.index.name = "DateTime"
+    parts = sorted(checkpoint_dir.glob("part-*.parquet"))
+    if not parts:
+        return pd.DataFrame({"price": pd.Series(dtype=float), "skipped": pd.Series(dtype=object)},
+                            index=pd.DatetimeIndex([], name="DateTime"))
+    done = pd.concat([pd.read_parquet(part) for part in parts])
+
+    return done[~done.index.duplicated(keep="last")].sort_index()
+
+
+def write_checkpoint(checkpoint_dir: Path, part: pd.DataFrame) -> Path:
+    """Appends the hours of part to the checkpoints (written to a temporary file first, so parts are never partial)."""
+
+    first, last = part.index[0], part.index[-1]
+    path = Path(checkpoint_dir) / f"part-{first:%Y%m%d%H}-{last:%Y%m%d%H}.parquet"
+    tmp = path.with_suffix(".tmp")
+    part.to_parquet(tmp)
+    os.replace(tmp, path)
+
+    return path
+
+
+def run_simulation(
+    input_folder: str,
+    start_str: str = "2019-01-01",
+    end_str: str = "2019-12-01",
+    mitigate_conduct: bool = True,
+    structural_threshold: int = 1,  # threshold for structural test
+    rel_conduct_threshold: int = 3, # relative threshold for conduct mitigation
+    abs_conduct_threshold: int = 100, # absolute threshold for conduct mitigation
+    verbose: bool = True,
+    workers: int = 1, # number of processes clearing the market
+    instr: Instrumentation = None, # collects the stage timings and skipped hours (see amp_tests.instrumentation)
+    checkpoint_dir: str = None, # folder of the checkpoints, to resume an interrupted or extended run
+    checkpoint_hours: int = 720, # hours simulated between two checkpoints
+) -> pd.Series:
+    """
+    Simulates one scenario between start_str and end_str. Returns the price series of the simulated hours.
+    With checkpoint_dir, the price and skip reason of every hour are appended to checkpoint_dir every
+    checkpoint_hours hours, with the scenario parameters in params.json. A new call with the same
+    checkpoint_dir only simulates the hours that are not there yet: an interrupted run resumes after its
+    last checkpoint, and extending end_str only simulates the new hours. Their data is read from the first
+    new hour, with the full look-back of the reference levels (see load_inputs), so the prices equal those
+    of an uninterrupted run (checked by benchmarks/check_equivalence.py).
+    """
+
+    instr = instr or Instrumentation()
+    date_range = pd.date_range(
+        start=start_str, end=end_str, freq="h", inclusive="left", name="DateTime")
+    params = dict(
+        input_folder=str(input_folder),
+        mitigate_conduct=mitigate_conduct,
+        structural_threshold=structural_threshold,
+        rel_conduct_threshold=rel_conduct_threshold,
+        abs_conduct_threshold=abs_conduct_threshold,
+    )
+
+    parts = [read_checkpoints(checkpoint_dir, params)] if checkpoint_dir is not None else []
+    todo = date_range.difference(parts[0].index) if parts else date_range
+    instr.count("resumed hours", len(date_range) - len(todo))
+
+    if len(todo):
+        inputs = load_inputs(input_folder, start=todo[0], end=todo[-1], instr=instr)
+        reasons = skip_reasons(inputs, todo)
+        simulation_hours(inputs, todo, instr=instr) # counts the skipped hours
+        block = checkpoint_hours if checkpoint_dir is not None else len(todo)
+
+        for i in range(0, len(todo), block):
+            part = reasons.iloc[i : i + block].to_frame()
+            hours = part.index[part["skipped"].isna()]
+            res = simulate(
+                inputs,
+                hours,
+                mitigate_conduct=mitigate_conduct,
+                structural_threshold=structural_threshold,
+                rel_conduct_threshold=rel_conduct_threshold,
+                abs_conduct_threshold=abs_conduct_threshold,
+                verbose=verbose,
+                workers=workers,
+                instr=instr,
+            )
+            part.insert(0, "price", res.reindex(part.index))
+            if checkpoint_dir is not None:
+                with instr.stage("write"):
+                    write_checkpoint(checkpoint_dir, part)
+            parts.append(part)
+
+    results = pd.concat(parts).sort_index().reindex(date_range)
+    res = results.loc[results["skipped"].isna(), "price"]
+    print(instr.summary()) if verbose else None
 
     return res
 
+
+def scenario_grid(**params: list) -> list[dict]:
+    """
+    Expands lists of parameter values into the list of all their combinations, e.g.
+    scenario_grid(structural_threshold=[1, np.inf], rel_conduct_threshold=[2, 3]) returns 4 scenarios.
+    """
+
+    keys = list(params)
+    return [dict(zip(keys, values)) for values in product(*params.values())]
+
+
+def scenario_name(scenario: dict) -> str:
+    """Column name of a scenario, built from its parameters."""
+    return ",".join(f"{k}={v}" for k, v in scenario.items())
+
+
+def run_scenarios(
+    input_folder: str,
+    scenarios: list[dict]|dict[str, dict],
+    start_str: str = "2019-01-01",
+    end_str: str = "2019-12-01",
+    verbose: bool = True,
+    workers: int = 1,
+    instr: Instrumentation = None,
+) -> pd.DataFrame:
+    """
+    Simulates several scenarios over the same period. Data is loaded and residual supplier index, reference
+    levels, congestion test and simulated hours are computed once and shared by all scenarios.
+    Scenarios are either a list of parameter dicts (e.g. from scenario_grid) or a dict {column name: parameters},
+    parameters being the keyword arguments of simulate (mitigate_conduct, structural_threshold, 
+    rel_conduct_threshold, abs_conduct_threshold). Missing parameters take the defaults of simulate.
+    workers is the number of processes clearing the market (1 clears in this process).
+    Stage timings and skipped hours of all the scenarios are collected in instr. The unmitigated supply stacks
+    are sorted once and each scenario only re-clears the offers changed by its mitigation.
+    Returns pd.DataFrame indexed by DateTime with one price column per scenario.
+    """
+
+    if not isinstance(scenarios, dict):
+        scenarios = {scenario_name(s): s for s in scenarios}
+
+    instr = instr or Instrumentation()
+    date_range = pd.date_range(
+        start=start_str, end=end_str, freq="h", inclusive="left")
+
+    inputs = load_inputs(input_folder, start=date_range[0], end=date_range[-1], instr=instr)
+    hours = simulation_hours(inputs, date_range, instr=instr)
+    with instr.stage("base_clearing"):
+        base = BaseClearing.from_inputs(inputs, hours)
+
+    runs = {}
+    cache = {}
+    for name, params in scenarios.items():
+        params = {**SCENARIO_DEFAULTS, **params}
+        if not params["mitigate_conduct"]: # thresholds are irrelevant without mitigation
+            params = {**SCENARIO_DEFAULTS, "mitigate_conduct": False}
+        key = tuple(sorted(params.items()))
+
+        if key not in cache:
+            print(f"Simulating scenario {name}.\n") if verbose else None
+            cache[key] = simulate(inputs, hours, verbose=verbose, workers=workers, instr=instr, base=base, **params)
+        runs[name] = cache[key]
+
+    runs = pd.DataFrame(runs, index=hours)
+    print(instr.summary()) if verbose else None
+
+    return runs
+
     
 if __name__ == "__main__":
     # parse arguments
     # args = parser.parse_args()
     #example usage 
+    instr = Instrumentation(profile=None) # e.g. profile="clearing" to run the clearing under cProfile
     res = run_simulation(
         input_folder=FOLDER,
         start_str="2019-01-01",  # Start date for the simulation
@@ -175,13 +443,17 @@ if __name__ == "__main__":
         mitigate_conduct=True,  # Whether to mitigate bids
         rel_conduct_threshold=3,  # Relative threshold for mitigation (change to make mitigation stricter)
         abs_conduct_threshold=100, # Absolute threshold for mitigation (change to make mitigation stricter)
+        instr=instr,
+        checkpoint_dir="output/e_checkpoints", # resumes from here if interrupted (delete to start over)
     )
 
-    res.to_frame().to_parquet("output/e_no_impact.parquet")
-    
-    a = pd.read_parquet("output/a.parquet")['price']
-    res = mitigate_impact(a, res, rel_impact_threshold=2, abs_impact_threshold=100)
-    res.to_frame().to_parquet("output/e.parquet")
+    with instr.stage("write"):
+        res.to_frame().to_parquet("output/e_no_impact.parquet")
+        
+        a = pd.read_parquet("output/a.parquet")['price']
+        res = mitigate_impact(a, res, rel_impact_threshold=2, abs_impact_threshold=100)
+        res.to_frame().to_parquet("output/e.parquet")
+    instr.save("output/e_report.json")
 
 
     #TODO: in main, add a parameter to remove the pivotality test
\ No newline at end of file
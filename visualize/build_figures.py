@@ -0,0 +1,209 @@
+"""
+
+Builds all the paper figures in one run: each dataset is read once (only the 2019 rows and the columns used
+by the figures), figures are rendered in a pool of processes and a figure is skipped if the fingerprint of
+its inputs (data files, plotting code and matplotlib config) did not change since the last build.
+
+Usage (from the repository root): python visualize/build_figures.py [--out DIR] [--workers N] [--force] [--only NAME ...]
+
+"""
+
+import sys
+import json
+import yaml
+import hashlib
+import inspect
+import argparse
+import matplotlib as mpl
+mpl.use("Agg")
+import pandas as pd
+import matplotlib.pyplot as plt
+from pathlib import Path
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(str(Path(__file__).parent.parent)) # add the path to the parent directory to sys.path
+from amp_tests.sources import read_source
+from visualize.bids import bids_violinplot, plot_ref_level
+from visualize.score_variables import plot_score_variables
+from visualize.simulations import plot_simulations
+from visualize.example import plot_example
+from visualize import fuzzy_cdf
+
+
+DATA = Path("data")
+CONFIG = Path("visualize/matplotlib_config.yaml")
+MANIFEST = ".figures.json"
+YEAR = 2019
+
+with open(CONFIG, "r") as f:
+    config = yaml.safe_load(f)
+
+# file and columns of each dataset, read once for all the figures
+DATASETS = {
+    "isone": ("2025-08-12_iso-ne_dataset.parquet", ["max_bid", "ref_level", "rsi"]),
+    "nyiso": ("2025-08-12_nyiso_dataset.parquet", ["max_bid", "avg_cong_1h_lag"]),
+    "all_runs": ("all_runs.parquet", None),
+}
+
+
+
+def violin_figure(isone, nyiso):
+    return bids_violinplot(isone.copy(), nyiso.copy(), year=YEAR)[0]
+
+
+def ref_level_figure(isone):
+    return plot_ref_level(isone.xs(44623, level='Masked Asset ID'), "44623")[0]
+
+
+def score_variables_figure(isone, nyiso):
+    return plot_score_variables(isone, nyiso)[0]
+
+
+def simulations_figure(all_runs):
+    starts = (pd.Timestamp('2019-11-01'),pd.Timestamp('2019-12-09'))
+    ends = (pd.Timestamp('2019-11-19'),pd.Timestamp('2019-12-25'))
+    return plot_simulations(all_runs, starts, ends)[0]
+
+
+def example_figure():
+    return plot_example()[0]
+
+
+def fuzzy_figure():
+    fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(12, 5), tight_layout=True)
+    fuzzy_cdf.plot_fuzzy_cdf(fuzzy_cdf.s, fuzzy_cdf.std_devs, fuzzy_cdf.colors, fuzzy_cdf.cutoff, ax0)
+    fuzzy_cdf.plot_fuzzy_pdf(fuzzy_cdf.x, fuzzy_cdf.std_devs, fuzzy_cdf.colors, ax1)
+    return fig
+
+
+
+@dataclass
+class Figure:
+    """A figure of the paper: plot builds it from the datasets in inputs, the code of module is part of its
+    fingerprint and styled figures use the ggplot style with the matplotlib config, as in their scripts."""
+
+    plot: callable
+    module: str
+    inputs: tuple = ()
+    savefig: dict = None
+    styled: bool = True
+
+
+FIGURES = {
+    "bids_violinplot.pdf": Figure(violin_figure, "bids", ("isone", "nyiso"), dict(bbox_inches='tight')),
+    "ref_level.pdf": Figure(ref_level_figure, "bids", ("isone",), dict(bbox_inches='tight')),
+    "score_variables.pdf": Figure(score_variables_figure, "score_variables", ("isone", "nyiso"), dict(bbox_inches='tight', dpi=300)),
+    "simulation_plot.pdf": Figure(simulations_figure, "simulations", ("all_runs",), dict(bbox_inches='tight', dpi=300)),
+    "example.svg": Figure(example_figure, "example", (), dict(bbox_inches='tight')),
+    "fuzzy_treatment.svg": Figure(fuzzy_figure, "fuzzy_cdf", (), dict(), styled=False),
+}
+
+
+
+def dataset_key(data: Path, name: str) -> str:
+    """Version of a dataset: its path, modification time and size, the columns read and the year."""
+    file, columns = DATASETS[name]
+    stat = (data / file).stat()
+    return f"{data / file}-{stat.st_mtime_ns}-{stat.st_size}-{columns}-{YEAR}"
+
+
+def figure_key(name: str, data: Path) -> str:
+    """Fingerprint of a figure: plotting code, matplotlib config and versions of its datasets."""
+
+    figure = FIGURES[name]
+    h = hashlib.sha1(inspect.getsource(figure.plot).encode())
+    h.update((Path(__file__).parent / f"{figure.module}.py").read_bytes())
+    h.update(CONFIG.read_bytes())
+    h.update(repr((figure.savefig, figure.styled)).encode())
+    for dataset in figure.inputs:
+        h.update(dataset_key(data, dataset).encode())
+
+    return h.hexdigest()
+
+
+def load_dataset(data: Path, name: str) -> pd.DataFrame:
+    """Reads the rows of YEAR and the columns used by the figures of a dataset."""
+    file, columns = DATASETS[name]
+    if name == "all_runs":
+        return pd.read_parquet(data / file, columns=columns)
+    return read_source(data / file, start=f"{YEAR}-01-01", end=f"{YEAR}-12-31", columns=columns)
+
+
+def render(name: str, inputs: dict, out: Path) -> Path:
+    """Worker task: renders and saves one figure."""
+
+    mpl.rcdefaults() # the style does not depend on the figures rendered before in this process
+    if FIGURES[name].styled:
+        plt.style.use('ggplot')
+        mpl.rcParams.update(config)
+    fig = FIGURES[name].plot(**inputs)
+    path = out / name
+    fig.savefig(path, **(FIGURES[name].savefig or {}))
+    plt.close(fig)
+
+    return path
+
+
+def build_figures(
+    data: Path = DATA,
+    out: Path = Path("."),
+    names: list = None,
+    workers: int = 4,
+    force: bool = False,
+) -> list[str]:
+    """
+    Builds the figures (all if names is None) that are missing or whose fingerprint changed since the last
+    build (all with force). Returns the names of the built figures.
+    """
+
+    out.mkdir(parents=True, exist_ok=True)
+    manifest_path = out / MANIFEST
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    names = list(FIGURES) if names is None else list(names)
+    for name in [n for n in names if any(not (data / DATASETS[d][0]).exists() for d in FIGURES[n].inputs)]:
+        print(f"Skipping {name} because its data is missing.")
+        names.remove(name)
+    keys = {name: figure_key(name, data) for name in names}
+    stale = [n for n in names if force or manifest.get(n) != keys[n] or not (out / n).exists()]
+    for name in [n for n in names if n not in stale]:
+        print(f"{name} is up to date.")
+
+    datasets = {d for n in stale for d in FIGURES[n].inputs}
+    datasets = {d: load_dataset(data, d) for d in datasets} # each dataset is read once
+
+    built = []
+    if not stale:
+        return built
+
+    with ProcessPoolExecutor(max(1, min(workers, len(stale)))) as executor:
+        futures = {
+            name: executor.submit(render, name, {d: datasets[d] for d in FIGURES[name].inputs}, out)
+            for name in stale
+        }
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"{name} failed: {e!r}")
+                continue
+            manifest[name] = keys[name]
+            built.append(name)
+            print(f"{name} built.")
+
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+    return built
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the paper figures.")
+    parser.add_argument("--data", type=Path, default=DATA, help="data folder")
+    parser.add_argument("--out", type=Path, default=Path("."), help="output folder of the figures")
+    parser.add_argument("--workers", type=int, default=4, help="number of rendering processes")
+    parser.add_argument("--force", action="store_true", help="rebuild all the figures")
+    parser.add_argument("--only", nargs="+", choices=list(FIGURES), default=None, help="only build these figures")
+    args = parser.parse_args()
+
+    build_figures(args.data, args.out, names=args.only, workers=args.workers, force=args.force)
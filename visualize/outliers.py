@@ -1,16 +1,69 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from tqdm import tqdm
+from matplotlib.collections import LineCollection
 
 # TODO: set default plt.rcParams
 
 
+def _quantile_lines(quant_df: pd.DataFrame, ax: plt.Axes, color: str, alpha: float = 0.1) -> None:
+    """Plots every row of quant_df as one line with markers, with a single LineCollection and a single marker plot."""
+
+    if quant_df.empty:
+        return
+
+    columns = quant_df.columns
+    numeric = pd.api.types.is_numeric_dtype(columns)
+    x = columns.to_numpy(dtype=float) if numeric else np.arange(len(columns), dtype=float)
+    y = quant_df.to_numpy(dtype=float)
+
+    segments = np.stack([np.broadcast_to(x, y.shape), y], axis=-1)
+    ax.add_collection(LineCollection(segments, colors=color, alpha=alpha))
+    ax.plot(np.tile(x, len(y)), y.ravel(), c=color, alpha=alpha, marker="o", linestyle="None")
+
+    if not numeric: # as the categorical axis of ax.plot(row)
+        ax.set_xticks(x, [str(c) for c in columns])
+
+
+def _line_density(quant_df: pd.DataFrame, ax: plt.Axes, bins: int = 200, resolution: int = 20) -> None:
+    """Plots the density of the rows of quant_df (lines interpolated between quantiles) as a 2D histogram."""
+
+    columns = quant_df.columns
+    if len(columns) < 2 or quant_df.empty:
+        return _quantile_lines(quant_df, ax, color="black")
+
+    numeric = pd.api.types.is_numeric_dtype(columns)
+    x = columns.to_numpy(dtype=float) if numeric else np.arange(len(columns), dtype=float)
+    y = quant_df.to_numpy(dtype=float)
+
+    grid = np.linspace(x[0], x[-1], (len(x) - 1) * resolution + 1)
+    seg = np.clip(np.searchsorted(x, grid, side="right") - 1, 0, len(x) - 2)
+    w = (grid - x[seg]) / (x[seg + 1] - x[seg])
+    lines = y[:, seg] * (1 - w) + y[:, seg + 1] * w # (rows, grid)
+
+    valid = ~np.isnan(lines)
+    counts, xedges, yedges = np.histogram2d(
+        np.broadcast_to(grid, lines.shape)[valid], lines[valid], bins=[len(grid) - 1, bins]
+    )
+    ax.pcolormesh(xedges, yedges, np.ma.masked_equal(counts.T, 0), cmap="Greys", norm="log")
+
+    if not numeric:
+        ax.set_xticks(x, [str(c) for c in columns])
+
+
 def quantiles(
-    quant_df: pd.DataFrame, outlier_ix: np.array = None, ax: plt.Axes = None, **kwargs
+    quant_df: pd.DataFrame,
+    outlier_ix: np.array = None,
+    ax: plt.Axes = None,
+    mode: str = "lines",  # "lines", "decimate" (at most max_rows normal rows) or "density"
+    max_rows: int = 5000,
+    **kwargs,
 ) -> tuple[plt.Figure, plt.Axes]:
     """Plot quantiles as a time series line plot.
-    Quantiles is a matrix of shape (n_observations, n_quantiles)."""
+    Quantiles is a matrix of shape (n_observations, n_quantiles).
+    Normal and outlier rows are drawn as two LineCollections. For very long series, mode="decimate" only
+    draws every k-th normal row and mode="density" draws the density of the normal rows; outliers are
+    always drawn as lines."""
 
     if ax is None:
         fig, ax = plt.subplots()
@@ -19,19 +72,46 @@ def quantiles(
         fig = ax.get_figure()
 
     outlier_ix = outlier_ix if outlier_ix is not None else []
-    for ix, row in tqdm(
-        quant_df.iterrows(), total=len(quant_df), desc="Plotting quantiles"
-    ):
-
-        if ix in outlier_ix:
-            ax.plot(row, c="red", alpha=0.1, marker="o")
-        else:
-            ax.plot(row, c="black", alpha=0.1, marker="o")
+    is_outlier = quant_df.index.isin(outlier_ix)
+    normal = quant_df[~is_outlier]
+
+    if mode == "lines":
+        _quantile_lines(normal, ax, color="black")
+    elif mode == "decimate":
+        _quantile_lines(normal.iloc[:: max(1, -(-len(normal) // max_rows))], ax, color="black")
+    elif mode == "density":
+        _line_density(normal, ax)
+    else:
+        raise ValueError(f"mode must be 'lines', 'decimate' or 'density', got {mode}.")
+
+    _quantile_lines(quant_df[is_outlier], ax, color="red")
+    ax.autoscale_view()
     ax.set(**kwargs)
 
     return fig, ax
 
 
+def _decimate(y: np.array, max_points: int = None) -> tuple[np.array, np.array]:
+    """Positions and values of y, reduced to the min and max of max_points // 2 buckets if y is longer
+    than max_points (the envelope of the line, and so its peaks, is kept)."""
+
+    y = np.asarray(y, dtype=float)
+    x = np.arange(len(y))
+    if max_points is None or len(y) <= max_points:
+        return x, y
+
+    size = -(-len(y) // (max_points // 2))
+    pad = np.full(-len(y) % size, np.nan)
+    buckets = np.concatenate([y, pad]).reshape(-1, size)
+    starts = x[::size]
+    lo = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    hi = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    ix = np.sort(np.stack([starts + lo, starts + hi], axis=1), axis=1).ravel()
+    ix = ix[ix < len(y)]
+
+    return ix, y[ix]
+
+
 def outliers(
     outlier_score: np.array,  # outlier scores for each observation
     outlier_ix: np.array,  # indices of outlier observations
@@ -39,6 +119,7 @@ def outliers(
     xlines: np.array = None,  # optional list of horizontal lines to plot
     other_lines: list = None,  # optional list of other lines to plot on secondary y-axis
     ax: plt.Axes = None,
+    max_points: int = None,  # optional decimation of the score line (min / max envelope)
     **kwargs,  # args for main axis
 ) -> tuple[plt.Figure, plt.Axes]:
     """Plot outlier scores as a time series line plot
@@ -51,7 +132,10 @@ def outliers(
     else:
         fig = ax.get_figure()
 
-    ax.plot(outlier_score)
+    if max_points is None:
+        ax.plot(outlier_score)
+    else:
+        ax.plot(*_decimate(outlier_score, max_points))
 
     ax.plot(
         outlier_ix, outlier_score[outlier_ix], c="red", marker="o", linestyle="None"
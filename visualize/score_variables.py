@@ -1,16 +1,9 @@
 import pandas as pd
 import numpy as np
-import doubleml as dml
-from doubleml.rdd import RDFlex
-from amp_tests.utils import fuzzy_treatment_assignment
-from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
-from pathlib import Path
 import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import seaborn as sns
 import matplotlib as mpl
 import yaml
-import matplotlib.pyplot as plt
 
 plt.style.use('ggplot')
 with open("visualize/matplotlib_config.yaml", "r") as f:
@@ -19,17 +12,13 @@ with open("visualize/matplotlib_config.yaml", "r") as f:
 mpl.rcParams.update(config)
 
 
-if __name__ == "__main__":
-    iso_ne = pd.read_parquet("data/2025-08-12_iso-ne_dataset.parquet")
-    iso_ne = iso_ne[iso_ne.index.get_level_values('DateTime').year == 2019]  # filter for the year 2019
-
-    nyiso = pd.read_parquet("data/2025-08-12_nyiso_dataset.parquet")
-    nyiso = nyiso[nyiso.index.get_level_values('DateTime').year == 2019]  # filter for the year 2019
 
+def plot_score_variables(iso_ne: pd.DataFrame, nyiso: pd.DataFrame) -> tuple[plt.Figure, tuple[plt.Axes, plt.Axes]]:
+    """Plot the distributions of the score variables (RSI in ISO-NE, lagged congestion in NYISO) with their cutoffs."""
 
     fig, (ax0, ax1) = plt.subplots(1,2, sharey=True, tight_layout=True)
     sns.histplot(iso_ne["rsi"], bins=np.arange(iso_ne["rsi"].min(), iso_ne["rsi"].max() +.2, .2), stat="probability", ax=ax0)
-    sns.histplot(nyiso["avg_cong_1h_lag"], bins=np.arange(nyiso["avg_cong_1h_lag"].min(), nyiso["avg_cong_1h_lag"].max() +10, 10), stat="probability", label="Variable distribution")
+    sns.histplot(nyiso["avg_cong_1h_lag"], bins=np.arange(nyiso["avg_cong_1h_lag"].min(), nyiso["avg_cong_1h_lag"].max() +10, 10), stat="probability", label="Variable distribution", ax=ax1)
     ax0.set_xlabel("Residual Supply Index")
     ax0.axvline(1, color="blue", ls="--", lw=3)
     ax1.set_xlabel("Avg. lagged congestion ($/MWh)")
@@ -40,4 +29,15 @@ if __name__ == "__main__":
     ax0.set_title("ISO-NE")
     ax1.set_title("NYISO")
 
-    fig.savefig("score_variables.pdf", bbox_inches='tight', dpi=300)
\ No newline at end of file
+    return fig, (ax0, ax1)
+
+
+if __name__ == "__main__":
+    iso_ne = pd.read_parquet("data/2025-08-12_iso-ne_dataset.parquet")
+    iso_ne = iso_ne[iso_ne.index.get_level_values('DateTime').year == 2019]  # filter for the year 2019
+
+    nyiso = pd.read_parquet("data/2025-08-12_nyiso_dataset.parquet")
+    nyiso = nyiso[nyiso.index.get_level_values('DateTime').year == 2019]  # filter for the year 2019
+
+    fig, (ax0, ax1) = plot_score_variables(iso_ne, nyiso)
+    fig.savefig("score_variables.pdf", bbox_inches='tight', dpi=300)